@@ -0,0 +1,124 @@
+"""Compare peak memory of decoding a large card listing with `.json()` and with
+`iter_items`.
+
+Serves a synthetic /api/card response of `--cards` card definitions from a local
+HTTP server and decodes it in a fresh subprocess per mode, so that each mode's
+peak RSS is measured on its own:
+
+    python benchmarks/streaming_json.py --cards 5000
+"""
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from oira.statistics.deployment.metabase import iter_items
+
+import argparse
+import json
+import requests
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+
+def card(card_id):
+    return {
+        "id": card_id,
+        "name": "Card {}".format(card_id),
+        "description": None,
+        "display": "line",
+        "collection_id": card_id % 30,
+        "database_id": card_id % 21,
+        "dataset_query": {
+            "database": card_id % 21,
+            "type": "query",
+            "query": {
+                "source-table": card_id,
+                "aggregation": [["count"]],
+                "breakout": [
+                    ["datetime-field", ["field-id", card_id * 10 + i], "month"]
+                    for i in range(5)
+                ],
+                "filter": ["and"]
+                + [["=", ["field-id", card_id * 10 + i], "value"] for i in range(20)],
+            },
+        },
+        "result_metadata": [
+            {
+                "base_type": "type/Text",
+                "display_name": "Column {}".format(i),
+                "name": "column_{}".format(i),
+                "special_type": "type/Category",
+                "fingerprint": {"global": {"distinct-count": i, "nil%": 0.0}},
+            }
+            for i in range(20)
+        ],
+        "visualization_settings": {
+            "graph.dimensions": ["start_date"],
+            "graph.metrics": ["count"],
+            "series_settings": {"count": {"display": "line", "title": "Count"}},
+        },
+    }
+
+
+def serve(num_cards):
+    body = json.dumps([card(card_id) for card_id in range(num_cards)]).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, len(body)
+
+
+def decode(mode, url):
+    """Decode the listing and print the peak RSS in kB and the elapsed time"""
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == "json":
+        cards = {card["name"]: card["id"] for card in requests.get(url).json()}
+    else:
+        result = requests.get(url, stream=True)
+        result.raw.decode_content = True
+        cards = {card["name"]: card["id"] for card in iter_items(result.raw)}
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    print(json.dumps({"cards": len(cards), "peak_kb": peak, "seconds": elapsed}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cards", type=int, default=5000)
+    parser.add_argument("--decode", choices=["json", "stream"], help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.decode:
+        return decode(args.decode, args.url)
+
+    server, size = serve(args.cards)
+    url = "http://127.0.0.1:{}/api/card".format(server.server_address[1])
+    print("{} cards, {:.1f} MB response".format(args.cards, size / 2**20))
+    for mode in ["json", "stream"]:
+        output = subprocess.check_output(
+            [sys.executable, __file__, "--decode", mode, "--url", url]
+        )
+        result = json.loads(output)
+        print(
+            "{:<7} peak RSS increase {:>8.1f} MB, {:.2f}s".format(
+                mode, result["peak_kb"] / 1024, result["seconds"]
+            )
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
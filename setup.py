@@ -29,6 +29,7 @@ setup(
     python_requires="~= 3.8",
     install_requires=[
         "alembic",
+        "ijson",
         "metabase-api",
         "setuptools",
         "SQLAlchemy[postgresql] >=1.2.999999",
@@ -36,5 +37,6 @@ setup(
     entry_points="""
     [console_scripts]
     init-metabase-instance = oira.statistics.deployment.scripts:init_metabase_instance
+    init-metabase-instances = oira.statistics.deployment.scripts:init_metabase_instances
     """,
 )
@@ -0,0 +1,186 @@
+from collections import defaultdict
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3 import HTTPResponse
+
+import gzip
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def relative_url(url):
+    parts = urlsplit(str(url))
+    return parts.path + ("?" + parts.query if parts.query else "")
+
+
+def body_hash(body, headers):
+    """Hash of a request body that doesn't depend on compression or key order.
+
+    Only the hash is stored, so that passwords don't end up in the cassette.
+    """
+    if not body:
+        return None
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if headers.get("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+    except ValueError:
+        pass
+    return hashlib.sha1(body).hexdigest()
+
+
+class Cassette(object):
+    """Recorded HTTP exchanges with a metabase instance.
+
+    Replaying looks up the recorded response by method, URL and request body. The
+    responses for the same request are replayed in the recorded order; once they
+    are used up the last one is repeated (e.g. for polling). Requests that have
+    not been recorded with the same body fall back to the responses recorded for
+    the same method and URL, and get a 404 if there are none.
+    """
+
+    def __init__(self, interactions=None):
+        self.interactions = interactions or []
+        self.played = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as cassette_file:
+            return cls(json.load(cassette_file)["interactions"])
+
+    def save(self, path):
+        with open(path, "w") as cassette_file:
+            json.dump({"version": 1, "interactions": self.interactions}, cassette_file)
+        log.info("Recorded {} requests to {}".format(len(self.interactions), path))
+
+    def _index(self):
+        self._exact = defaultdict(list)
+        self._loose = defaultdict(list)
+        for interaction in self.interactions:
+            key = (interaction["method"], interaction["url"])
+            self._exact[key + (interaction["body_hash"],)].append(interaction)
+            self._loose[key].append(interaction)
+        self._played = defaultdict(int)
+
+    def record(
+        self, method, url, body, headers, status, response_headers, content, latency
+    ):
+        interaction = {
+            "method": method,
+            "url": relative_url(url),
+            "body_hash": body_hash(body, headers),
+            "status": status,
+            "headers": {
+                key: value
+                for key, value in response_headers.items()
+                if key.lower() in ("content-type", "location")
+            },
+            "body": content.decode("utf-8", "replace"),
+            "latency": latency,
+        }
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def play(self, method, url, body, headers):
+        url = relative_url(url)
+        with self._lock:
+            self.played += 1
+            for key in [
+                (method, url, body_hash(body, headers)),
+                (method, url),
+            ]:
+                interactions = (self._exact if len(key) == 3 else self._loose).get(key)
+                if interactions:
+                    index = min(self._played[key], len(interactions) - 1)
+                    self._played[key] += 1
+                    return interactions[index]
+            self.misses += 1
+        log.warning("{} {} not found in cassette".format(method, url))
+        return {
+            "status": 404,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps({"message": "Not found in cassette"}),
+            "latency": 0,
+        }
+
+
+class ReplayLatency(object):
+    """Delay of replayed responses: a fixed number of seconds or "recorded" """
+
+    def __init__(self, value="0"):
+        self.value = value
+
+    def __call__(self, interaction):
+        if self.value == "recorded":
+            return interaction["latency"]
+        return float(self.value)
+
+
+def raw_response(content, headers, status):
+    return HTTPResponse(
+        body=io.BytesIO(content),
+        headers=headers,
+        status=status,
+        preload_content=False,
+        decode_content=False,
+    )
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests to metabase and records them in a cassette"""
+
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        content = response.content
+        if kwargs.get("stream"):
+            # the body has been read, provide it again for streaming callers
+            response.raw = raw_response(content, {}, response.status_code)
+        self.cassette.record(
+            request.method,
+            request.url,
+            request.body,
+            request.headers,
+            response.status_code,
+            response.headers,
+            content,
+            time.perf_counter() - start,
+        )
+        return response
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Answers requests from a cassette without contacting metabase"""
+
+    def __init__(self, cassette, latency=None, **kwargs):
+        self.cassette = cassette
+        self.latency = latency or ReplayLatency()
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        interaction = self.cassette.play(
+            request.method, request.url, request.body, request.headers
+        )
+        time.sleep(self.latency(interaction))
+        raw = raw_response(
+            interaction["body"].encode("utf-8"),
+            interaction["headers"],
+            interaction["status"],
+        )
+        return self.build_response(request, raw)
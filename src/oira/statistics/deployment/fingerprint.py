@@ -0,0 +1,75 @@
+import hashlib
+import json
+
+
+# The fields that decide whether an existing object has to be updated. Others
+# are computed by metabase (e.g. `result_metadata`) or only used by us (e.g. the
+# `width` and `height` of cards on dashboards).
+compared_fields = {
+    "card": (
+        "name",
+        "description",
+        "display",
+        "collection_id",
+        "dataset_query",
+        "visualization_settings",
+    ),
+    "collection": ("name", "description", "color"),
+    "dashboard": ("name", "description", "collection_id", "collection_position"),
+}
+
+
+def normalize_query(value):
+    """Rewrite legacy field clauses the way metabase stores them.
+
+    Metabase saves e.g. ["datetime-field", ["field-id", 42], "month"] as
+    ["field", 42, {"temporal-unit": "month"}], so that the queries of the card
+    definitions would never be equal to the saved ones otherwise.
+    """
+    if isinstance(value, dict):
+        return {key: normalize_query(item) for key, item in value.items()}
+    if not isinstance(value, list):
+        return value
+    value = [normalize_query(item) for item in value]
+    if len(value) == 2 and value[0] == "field-id":
+        return ["field", value[1], None]
+    if len(value) == 3 and value[0] == "field-literal":
+        return ["field", value[1], {"base-type": value[2]}]
+    if (
+        len(value) == 3
+        and value[0] == "datetime-field"
+        and isinstance(value[1], list)
+        and value[1][0] == "field"
+    ):
+        options = dict(value[1][2] or {}, **{"temporal-unit": value[2]})
+        return ["field", value[1][1], options]
+    return value
+
+
+def fingerprint(obj_type, obj):
+    """Hash of the compared fields of an object definition or a live object.
+
+    Empty fields are left out, so that fields that we don't set and that are
+    empty in metabase don't make a difference.
+    """
+    fields = {
+        field: obj[field]
+        for field in compared_fields[obj_type]
+        if obj.get(field) is not None
+    }
+    if "dataset_query" in fields:
+        fields["dataset_query"] = normalize_query(fields["dataset_query"])
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def fingerprint_table(table):
+    """Hash of the fingerprints that metabase computed for the fields of a table
+    when it last analyzed its data, and of its row count if metabase knows it"""
+    fields = sorted(
+        [field["name"], field.get("fingerprint")] for field in table["fields"]
+    )
+    canonical = json.dumps(
+        [table.get("rows"), fields], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
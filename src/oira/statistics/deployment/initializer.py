@@ -1,11 +1,38 @@
 from . import config
+from .cassette import Cassette
+from .cassette import RecordingAdapter
+from .cassette import ReplayAdapter
+from .cassette import ReplayLatency
 from .content import CardFactory
 from .content import SectorCardFactory
+from .fingerprint import compared_fields
+from .fingerprint import fingerprint
+from .fingerprint import fingerprint_table
+from .instrumentation import RequestStats
+from .journal import Journal
+from .journal import run_fingerprint
+from .layout import DashboardLayout
+from .layout import sync_dashcards
+from .metabase import AdaptiveConcurrency
 from .metabase import OiraMetabase_API
+from .metabase import ResponseCache
+from .metabase import RetryPolicy
+from .permissions import update_graph
+from .plan import NotPlannable
+from .plan import Plan
+from .plan import plan_secrets
+from .profiling import Profiler
+from .scheduler import Scheduler
+from .scheduler import TaskFailed
+from .sync import DatabaseSyncs
+from .sync import MetadataState
+from .users import UserSync
+from .users import read_users_csv
+from concurrent.futures import ThreadPoolExecutor
 from pkg_resources import resource_string
-from time import sleep
 
 import logging
+import threading
 
 
 log = logging.getLogger(__name__)
@@ -13,40 +40,164 @@ log = logging.getLogger(__name__)
 
 class MetabaseInitializer(object):
     _total_cols = 16
+    _metadata_workers = 4
 
-    def __init__(self, args):
+    def __init__(self, args, stats=None):
         self.args = args
         self.engine = args.database_engine
         api_url = "http://{args.metabase_host}:{args.metabase_port}".format(args=args)
-        self.mb = OiraMetabase_API(api_url, args.metabase_user, args.metabase_password)
+        pool_size = max(args.metabase_pool_size, args.jobs)
+        if args.database_sync_concurrency > 1:
+            # the database syncs and their metadata requests run in addition to
+            # the jobs
+            pool_size = max(
+                pool_size,
+                args.jobs + args.database_sync_concurrency * self._metadata_workers,
+            )
+        concurrency = None
+        if args.metabase_max_concurrency:
+            concurrency = AdaptiveConcurrency(
+                floor=args.metabase_min_concurrency,
+                ceiling=args.metabase_max_concurrency,
+            )
+            pool_size = max(pool_size, concurrency.ceiling)
+        adapter = None
+        self.cassette = None
+        if args.replay_cassette:
+            self.cassette = Cassette.load(args.replay_cassette)
+            adapter = ReplayAdapter(
+                self.cassette, latency=ReplayLatency(args.replay_latency)
+            )
+        elif args.record_cassette:
+            self.cassette = Cassette()
+            adapter = RecordingAdapter(
+                self.cassette,
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+            )
+        self.mb = OiraMetabase_API(
+            api_url,
+            args.metabase_user,
+            args.metabase_password,
+            pool_size=pool_size,
+            timeout=args.metabase_timeout,
+            retry_policy=RetryPolicy(
+                max_attempts=args.metabase_retries + 1,
+                budget=args.metabase_retry_budget,
+            ),
+            cache=ResponseCache() if args.metabase_cache else None,
+            stats=stats if stats is not None else RequestStats(),
+            compress_requests=args.metabase_compress_requests,
+            adapter=adapter,
+            concurrency=concurrency,
+            plan=Plan(secrets=plan_secrets(args)) if args.plan else None,
+        )
         self._existing_items = None
+        self._fingerprints = {}
+        self.metadata_state = MetadataState.load(
+            args.metadata_state, rescan_interval=args.metadata_rescan_interval
+        )
+        self.syncs = DatabaseSyncs(
+            self.mb,
+            max_syncs=args.database_sync_concurrency,
+            timeout=args.database_sync_timeout,
+        )
+        self._existing_items_lock = threading.RLock()
+        self.profiler = None
+        if args.profile:
+            self.profiler = Profiler(memory=args.profile_memory)
+            self.mb.stats.observers.append(self.profiler.observe)
+            self.profiler.profile_methods(
+                self,
+                [name for name in dir(self) if name.startswith("set_up_")]
+                + ["sync_database", "create"],
+            )
 
     def __call__(self):
-        self.mb.put("/api/setting/show-homepage-xrays", json={"value": False})
-        self.mb.put("/api/setting/show-homepage-data", json={"value": False})
-        for database in self.mb.get("/api/database").json()["data"]:
-            if database["name"] == "Sample Dataset":
-                self.mb.delete("/api/database/{}".format(database["id"]))
+        journal = None
+        if self.args.resume and self.mb.plan is None:
+            journal = Journal.load(self.args.resume, run_fingerprint(self.args))
+        scheduler = Scheduler(
+            jobs=self.args.jobs, expected=(NotPlannable,), journal=journal
+        )
+        self.add_tasks(scheduler)
+        if self.args.only:
+            self.select_tasks(scheduler)
+        try:
+            scheduler.run()
+        except TaskFailed:
+            if self.mb.plan is None or any(
+                task.error is not None and not isinstance(task.error, NotPlannable)
+                for task in scheduler.tasks.values()
+            ):
+                raise
+            self.mb.plan.incomplete = [
+                task.name
+                for task in scheduler.tasks.values()
+                if task.state in ("failed", "skipped")
+            ]
+        finally:
+            log.info(scheduler.report())
+            if self.profiler is not None:
+                self.mb.stats.observers.remove(self.profiler.observe)
+                log.info("Profile:\n{}".format(self.profiler.tree()))
+                self.profiler.write_trace(self.args.profile)
+            if journal is not None and journal.resumed:
+                log.info(
+                    "Skipped {} steps that completed in an earlier run".format(
+                        len(journal.resumed)
+                    )
+                )
+        if journal is not None:
+            # the next run starts from the beginning again
+            journal.remove()
 
-        self.set_up_start_here_dashboard()
+        log.info(
+            "Done initializing metabase instance, skipped {} session validation "
+            "requests".format(self.mb.skipped_validations)
+        )
+        if self.syncs.durations:
+            log.info("Database syncs: {}".format(self.syncs.report()))
+        if self.args.metadata_state and self.mb.plan is None:
+            self.metadata_state.save(self.args.metadata_state)
+        if self.mb.cache is not None:
+            log.info("Response cache: {}".format(self.mb.cache.report()))
+        if self.mb.concurrency is not None:
+            log.info("Adaptive concurrency: {}".format(self.mb.concurrency.report()))
 
-        global_group_id = self.set_up_global_group()
+    def add_tasks(self, scheduler):
+        """Add the steps of setting up the instance to `scheduler`.
+
+        The dependencies between the steps are given by the ids they need from
+        other steps, see scheduler.Result.
+        """
+        add = scheduler.add
+        add("settings", self.set_up_settings)
+        add("dashboard:start-here", self.set_up_start_here_dashboard)
+        global_group_id = add("group:global", self.set_up_global_group)
 
         if self.args.global_statistics:
-            global_database_id = self.set_up_database(engine=self.engine)
-            global_collection_id = self.set_up_global_collection()
-            self.set_up_account(
-                database_id=global_database_id, collection_id=global_collection_id
-            )
-            self.set_up_assessment(
-                database_id=global_database_id, collection_id=global_collection_id
+            global_database_id = add(
+                "sync:global",
+                self.sync_database,
+                add("database:global", self.set_up_database, engine=self.engine),
+                waiting=True,
             )
-            self.set_up_tool(
-                database_id=global_database_id, collection_id=global_collection_id
-            )
-            self.set_up_questionnaire(
-                database_id=global_database_id, collection_id=global_collection_id
+            global_collection_id = add(
+                "collection:global", self.set_up_global_collection
             )
+            for dashboard, set_up in [
+                ("account", self.set_up_account),
+                ("assessment", self.set_up_assessment),
+                ("tool", self.set_up_tool),
+                ("questionnaire", self.set_up_questionnaire),
+            ]:
+                add(
+                    "dashboard:{}:global".format(dashboard),
+                    set_up,
+                    database_id=global_database_id,
+                    collection_id=global_collection_id,
+                )
 
         # `countries` has this format:
         # countries = {
@@ -63,46 +214,61 @@ class MetabaseInitializer(object):
                 country.strip(): {} for country in self.args.countries.split(",")
             }
 
-            for country in countries:
-                countries[country]["group"] = self.set_up_country_group(country)
-                if not self.args.global_statistics:
-                    countries[country]["database"] = self.set_up_database(
-                        country=country, engine=self.engine
-                    )
-                    countries[country]["collection"] = self.set_up_country_collection(
-                        country
-                    )
-                    self.set_up_account(
-                        country=country,
-                        database_id=countries[country]["database"],
-                        collection_id=countries[country]["collection"],
-                    )
-                    self.set_up_assessment(
-                        country=country,
-                        database_id=countries[country]["database"],
-                        collection_id=countries[country]["collection"],
-                    )
-                    self.set_up_tool(
-                        country=country,
-                        database_id=countries[country]["database"],
-                        collection_id=countries[country]["collection"],
-                    )
-                    self.set_up_questionnaire(
+            for country, country_info in countries.items():
+                country_info["group"] = add(
+                    "group:{}".format(country), self.set_up_country_group, country
+                )
+                if self.args.global_statistics:
+                    continue
+                country_info["database"] = add(
+                    "database:{}".format(country),
+                    self.set_up_database,
+                    country=country,
+                    engine=self.engine,
+                )
+                database_id = add(
+                    "sync:{}".format(country),
+                    self.sync_database,
+                    country_info["database"],
+                    country=country,
+                    waiting=True,
+                )
+                country_info["collection"] = add(
+                    "collection:{}".format(country),
+                    self.set_up_country_collection,
+                    country,
+                )
+                dashboards = [
+                    ("account", self.set_up_account),
+                    ("assessment", self.set_up_assessment),
+                    ("tool", self.set_up_tool),
+                    ("questionnaire", self.set_up_questionnaire),
+                ]
+                if country.upper() == "FR":
+                    dashboards.append(("inrs", self.set_up_inrs))
+                for dashboard, set_up in dashboards:
+                    add(
+                        "dashboard:{}:{}".format(dashboard, country),
+                        set_up,
                         country=country,
-                        database_id=countries[country]["database"],
-                        collection_id=countries[country]["collection"],
+                        database_id=database_id,
+                        collection_id=country_info["collection"],
                     )
-                    if country.upper() == "FR":
-                        self.set_up_inrs(
-                            country=country,
-                            database_id=countries[country]["database"],
-                            collection_id=countries[country]["collection"],
-                        )
 
             if not self.args.global_statistics:
-                self.set_up_country_permissions(countries, global_group_id)
+                add(
+                    "permissions:countries",
+                    self.set_up_country_permissions,
+                    countries,
+                    global_group_id,
+                )
             else:
-                self.set_up_countries_overview(global_database_id, global_collection_id)
+                add(
+                    "dashboard:countries-overview",
+                    self.set_up_countries_overview,
+                    global_database_id,
+                    global_collection_id,
+                )
 
         # `sectors` has this format:
         # sectors = {
@@ -120,8 +286,23 @@ class MetabaseInitializer(object):
         # }
         sectors = {}
         if self.args.global_statistics:
-            sectors = self.set_up_sectors(global_database_id, global_collection_id)
-            self.set_up_global_permissions(
+            for sector_name in config.sectors:
+                sectors[sector_name] = add(
+                    "sector:{}".format(sector_name),
+                    self.set_up_sector,
+                    sector_name,
+                    global_database_id,
+                )
+            add(
+                "dashboard:sectors-overview",
+                self.set_up_sectors_overview,
+                sectors,
+                global_database_id,
+                global_collection_id,
+            )
+            add(
+                "permissions:global",
+                self.set_up_global_permissions,
                 global_database_id,
                 countries,
                 sectors,
@@ -130,51 +311,75 @@ class MetabaseInitializer(object):
             )
 
         if self.args.ldap_host:
-            self.set_up_ldap(countries, global_group_id)
+            add("ldap", self.set_up_ldap, countries, global_group_id)
 
-        if self.args.statistics_user:
-            users = self.mb.get("/api/user").json()["data"]
-            user_emails = [user["email"] for user in users]
-            for email, password, first_name, last_name in (
-                self.args.statistics_user or []
-            ):
-                if email not in user_emails:
-                    log.info("Creating user {}".format(email))
-                    self.mb.post(
-                        "/api/user",
-                        json={
-                            "first_name": first_name,
-                            "last_name": last_name,
-                            "email": email,
-                            "password": password,
-                            "group_ids": [1, 4],
-                        },
-                    )
-                else:
-                    log.info("Modifying user {}".format(email))
-                    user_id = [user["id"] for user in users if user["email"] == email][
-                        0
-                    ]
-                    self.mb.put(
-                        "/api/user/{}".format(user_id),
-                        json={
-                            "first_name": first_name,
-                            "last_name": last_name,
-                            "email": email,
-                            "password": password,
-                            "group_ids": [1, 4],
-                        },
-                    )
+        users = list(self.args.statistics_user or [])
+        if self.args.statistics_users_csv:
+            users.extend(read_users_csv(self.args.statistics_users_csv))
+        if users:
+            # group 4 is the first one created, i.e. the global group
+            add("users", self.set_up_statistics_users, users, depends=["group:global"])
 
-        log.info("Done initializing metabase instance")
+    def task_labels(self, name, countries):
+        """The parts of the set up a task belongs to, see --only"""
+        parts = name.lower().split(":")
+        labels = {"step": parts[0]}
+        if parts[0] in ("dashboard", "sector"):
+            labels[parts[0]] = parts[1]
+        if len(parts) > 1 and parts[-1] in countries:
+            labels["country"] = parts[-1]
+        return labels
 
-    def set_up_database(self, country=None, engine="postgres"):
-        if country is None:
-            db_name = "statistics_global"
-        else:
-            db_name = self.args.database_pattern_statistics.format(
-                country=country.lower()
+    def select_tasks(self, scheduler):
+        """Only run the tasks that match all --only selectors, and the tasks
+        that they need ids from"""
+        selectors = {}
+        for kind, values in self.args.only:
+            selectors.setdefault(kind, set()).update(values)
+        countries = {
+            country.strip().lower()
+            for country in (self.args.countries or "").split(",")
+            if country.strip()
+        }
+        selected = [
+            name
+            for name in scheduler.tasks
+            if all(
+                self.task_labels(name, countries).get(kind) in values
+                for kind, values in selectors.items()
             )
+        ]
+        if not selected:
+            raise ValueError("No set up steps match the --only selectors")
+        for name in scheduler.select(selected):
+            if not name.startswith("sync:"):
+                continue
+            # Only the id of a database that already exists is needed, don't
+            # sync it again. A database created by this run needs its initial
+            # sync.
+            task = scheduler.tasks[name]
+            db_name = self.database_name(task.kwargs.get("country"))
+            if db_name in self.existing_items["databases"]:
+                task.func = self.synced_database
+        log.info("Only setting up {}".format(", ".join(selected)))
+
+    def set_up_settings(self):
+        self.mb.put("/api/setting/show-homepage-xrays", json={"value": False})
+        self.mb.put("/api/setting/show-homepage-data", json={"value": False})
+        for database in self.mb.get("/api/database").json()["data"]:
+            if database["name"] == "Sample Dataset":
+                self.mb.delete("/api/database/{}".format(database["id"]))
+
+    def set_up_statistics_users(self, users):
+        UserSync(self.mb, [1, 4], reset_passwords=self.args.reset_passwords).sync(users)
+
+    def database_name(self, country=None):
+        if country is None:
+            return "statistics_global"
+        return self.args.database_pattern_statistics.format(country=country.lower())
+
+    def set_up_database(self, country=None, engine="postgres"):
+        db_name = self.database_name(country)
         details = {
             "dbname": db_name,
         }
@@ -194,43 +399,75 @@ class MetabaseInitializer(object):
             "engine": engine,
             "details": details,
         }
-        db_id = self.create("database", db_name, extra_data=db_data)
-
-        self.mb.post("/api/database/{}/sync".format(db_id))
-        while not [
-            entry["msg"]
-            for entry in self.mb.get("/api/util/logs").json()
-            if "FINISHED: Sync {} Database {} '{}'".format(engine, db_id, db_name)
-            in entry["msg"]
-        ]:
-            log.info("Waiting for database sync to finish...")
-            sleep(1)
+        return self.create("database", db_name, extra_data=db_data)
+
+    def synced_database(self, db_id, country=None):
+        return db_id
+
+    def sync_database(self, db_id, country=None):
+        """Sync the database and adapt the metadata of its tables"""
+        db_name = self.database_name(country)
+        self.syncs.sync(db_id, db_name)
 
         db_info = self.mb.get(
             "/api/database/{}/metadata?include_hidden=true".format(db_id)
         ).json()
+        # Only the settings that aren't in place yet are changed. The values
+        # of a table are only scanned again if it changed since the last scan
+        # or the last scan is too old, see MetadataState. A scan is only
+        # recorded once metabase accepted it.
+        calls = []
         for table_info in db_info["tables"]:
-            self.mb.post(
-                "/api/table/{}/rescan_values".format(table_info["id"]),
-                json={},
-            )
-            self.mb.put(
-                "/api/table/{}".format(table_info["id"]),
-                json={"field_order": "database"},
-            )
+            table_fingerprint = fingerprint_table(table_info)
+            if self.metadata_state.rescan_needed(
+                db_name, table_info["name"], table_fingerprint
+            ):
+                calls.append(
+                    (
+                        "POST",
+                        "/api/table/{}/rescan_values".format(table_info["id"]),
+                        {},
+                        (db_name, table_info["name"], table_fingerprint),
+                    )
+                )
+            if table_info.get("field_order") != "database":
+                calls.append(
+                    (
+                        "PUT",
+                        "/api/table/{}".format(table_info["id"]),
+                        {"field_order": "database"},
+                        None,
+                    )
+                )
             for field_info in table_info["fields"]:
                 if (
                     table_info["name"] in ["assessment", "company"]
                     and field_info["name"] == "id"
                     or (country is not None and field_info["name"] == "country")
-                ):
-                    self.mb.put(
-                        "/api/field/{}".format(field_info["id"]),
-                        json={"visibility_type": "sensitive"},
+                ) and field_info.get("visibility_type") != "sensitive":
+                    calls.append(
+                        (
+                            "PUT",
+                            "/api/field/{}".format(field_info["id"]),
+                            {"visibility_type": "sensitive"},
+                            None,
+                        )
                     )
+        log.info("Updating metadata of {}: {} requests".format(db_name, len(calls)))
+        if calls:
+            with ThreadPoolExecutor(
+                max_workers=min(len(calls), self._metadata_workers)
+            ) as executor:
+                list(executor.map(self._update_metadata, calls))
 
         return db_id
 
+    def _update_metadata(self, call):
+        method, endpoint, body, scan = call
+        result = self.mb.request(method, endpoint, json=body)
+        if result.ok and scan is not None and self.mb.plan is None:
+            self.metadata_state.scanned(*scan)
+
     def create(self, obj_type, obj_name, extra_data={}, reuse=True):
         if obj_type == "group":
             url = "/api/permissions/group"
@@ -240,36 +477,40 @@ class MetabaseInitializer(object):
         obj_data.update(extra_data)
 
         obj_exists = obj_name in self.existing_items[obj_type + "s"]
+        fingerprints = self.fingerprints.get(obj_type + "s")
+        obj_fingerprint = None
+        if fingerprints is not None:
+            obj_fingerprint = fingerprint(obj_type, obj_data)
         if obj_exists:
             obj_id = self.existing_items[obj_type + "s"][obj_name]
             if reuse:
                 log.info("Keeping existing {} '{}'".format(obj_type, obj_name))
-                if extra_data:
+                if extra_data and (
+                    obj_fingerprint is None
+                    or fingerprints.get(obj_name) != obj_fingerprint
+                ):
                     obj_info = self.mb.put(
                         "{}/{}".format(url, obj_id),
                         json=obj_data,
                     ).json()
                 else:
-                    obj_info = self.mb.get("{}/{}".format(url, obj_id)).json()
+                    # unchanged, only the id is needed
+                    obj_info = {"id": obj_id}
             else:
                 log.info("Deleting existing {} '{}'".format(obj_type, obj_name))
                 self.mb.delete("{}/{}".format(url, obj_id))
         if not obj_exists or (obj_exists and not reuse):
             log.info("Adding {} '{}'".format(obj_type, obj_name))
-            result = self.mb.post(
+            # "duplicate key" errors are retried by the metabase client
+            obj_info = self.mb.post(
                 url,
                 json=obj_data,
-            )
-            obj_info = result.json()
-            if not result.ok and "duplicate key" in obj_info.get("message", ""):
-                # retry, this usually goes away by itself
-                log.info('Retrying after "duplicate key" error')
-                result = self.mb.post(
-                    url,
-                    json=obj_data,
-                )
-                obj_info = result.json()
+            ).json()
         obj_id = obj_info["id"]
+        with self._existing_items_lock:
+            self.existing_items[obj_type + "s"][obj_name] = obj_id
+            if obj_fingerprint is not None:
+                fingerprints[obj_name] = obj_fingerprint
         return obj_id
 
     def set_up_start_here_dashboard(self):
@@ -285,43 +526,9 @@ class MetabaseInitializer(object):
             "dashboard", "-> Start here", extra_data=dashboard_data
         )
 
-        existing_cards = self.mb.get("/api/dashboard/{}".format(dashboard_id)).json()[
-            "ordered_cards"
-        ]
-        if len(existing_cards) > 0:
-            card_id = existing_cards[0]["id"]
-        else:
-            new_card = self.mb.post(
-                "/api/dashboard/{}/cards".format(dashboard_id),
-                json={"cardId": None},
-            ).json()
-            card_id = new_card["id"]
-
-        intro_card = {
-            "id": card_id,
-            "card_id": None,
-            "parameter_mappings": [],
-            "series": [],
-            "visualization_settings": {
-                "virtual_card": {
-                    "archived": False,
-                    "dataset_query": {},
-                    "name": None,
-                    "display": "text",
-                    "visualization_settings": {},
-                },
-                "text": intro_text,
-            },
-            "dashboard_id": dashboard_id,
-            "size_x": 8,
-            "size_y": 9,
-            "col": 0,
-            "row": 0,
-        }
-        self.mb.put(
-            "/api/dashboard/{}/cards".format(dashboard_id),
-            json={"cards": [intro_card]},
-        )
+        layout = DashboardLayout(self._total_cols)
+        layout.add_text(intro_text, size_x=8, size_y=9)
+        sync_dashcards(self.mb, dashboard_id, layout.dashcards)
 
     def set_up_global_group(self):
         return self.create("group", "global")
@@ -349,147 +556,132 @@ class MetabaseInitializer(object):
         all_users_id = str(self.existing_items["groups"]["All Users"])
 
         # Database permissions
-        permissions = self.mb.get("/api/permissions/graph").json()
-        permissions["groups"].update(
-            dict(
-                {
-                    str(all_users_id): {
-                        str(global_database_id): {"data": {"schemas": "none"}},
-                    },
-                    str(global_group_id): {
-                        str(global_database_id): {"data": {"schemas": "all"}},
-                    },
+        permissions = dict(
+            {
+                str(all_users_id): {
+                    str(global_database_id): {"data": {"schemas": "none"}},
                 },
-                **{
-                    str(country_info["group"]): {
-                        str(global_database_id): {"data": {"schemas": "all"}},
-                    }
-                    for country_info in countries.values()
+                str(global_group_id): {
+                    str(global_database_id): {"data": {"schemas": "all"}},
                 },
-            )
+            },
+            **{
+                str(country_info["group"]): {
+                    str(global_database_id): {"data": {"schemas": "all"}},
+                }
+                for country_info in countries.values()
+            },
         )
 
-        self.mb.put("/api/permissions/graph", json=permissions)
+        update_graph(self.mb, "/api/permissions/graph", permissions)
 
         # Collection permissions
-        collection_permissions = self.mb.get("/api/collection/graph").json()
-        collection_permissions["groups"].update(
-            dict(
-                {
-                    str(all_users_id): dict(
-                        {
-                            str(global_collection_id): "none",
-                        },
-                        **{
-                            str(sector["collection"]): "none"
-                            for sector in sectors.values()
-                        },
-                    ),
-                    str(global_group_id): dict(
+        collection_permissions = dict(
+            {
+                str(all_users_id): dict(
+                    {
+                        str(global_collection_id): "none",
+                    },
+                    **{
+                        str(sector["collection"]): "none" for sector in sectors.values()
+                    },
+                ),
+                str(global_group_id): dict(
+                    {
+                        str(global_collection_id): "read",
+                    },
+                    **{
+                        str(sector["collection"]): "read" for sector in sectors.values()
+                    },
+                ),
+            },
+            **{
+                str(country_info["group"]): dict(
+                    {
+                        str(global_collection_id): "read",
+                    },
+                    **(
                         {
-                            str(global_collection_id): "read",
-                        },
-                        **{
                             str(sector["collection"]): "read"
                             for sector in sectors.values()
-                        },
+                        }
+                        if country_id == "eu"
+                        else {}
                     ),
-                },
-                **{
-                    str(country_info["group"]): dict(
-                        {
-                            str(global_collection_id): "read",
-                        },
-                        **(
-                            {
-                                str(sector["collection"]): "read"
-                                for sector in sectors.values()
-                            }
-                            if country_id == "eu"
-                            else {}
-                        ),
-                    )
-                    for country_id, country_info in countries.items()
-                },
-            )
+                )
+                for country_id, country_info in countries.items()
+            },
         )
 
-        self.mb.put("/api/collection/graph", json=collection_permissions)
+        update_graph(self.mb, "/api/collection/graph", collection_permissions)
 
     def set_up_country_permissions(self, countries, global_group_id):
         log.info("Setting up country permissions")
         all_users_id = str(self.existing_items["groups"]["All Users"])
 
         # Database permissions
-        permissions = self.mb.get("/api/permissions/graph").json()
-        permissions["groups"].update(
-            dict(
-                {
-                    str(all_users_id): {
-                        str(country_info["database"]): {"data": {"schemas": "none"}}
-                        for country_info in countries.values()
-                    },
-                    str(global_group_id): {
-                        str(country_info["database"]): {"data": {"schemas": "all"}}
-                        for country_info in countries.values()
-                    },
+        permissions = dict(
+            {
+                str(all_users_id): {
+                    str(country_info["database"]): {"data": {"schemas": "none"}}
+                    for country_info in countries.values()
                 },
-                **{
-                    str(country_info["group"]): dict(
-                        {
-                            str(country_info["database"]): {"data": {"schemas": "all"}},
-                        },
-                        **{
-                            str(country_other["database"]): {
-                                "data": {"schemas": "none"}
-                            }
-                            for country_other in countries.values()
-                            if country_info["group"] != country_other["group"]
-                        },
-                    )
+                str(global_group_id): {
+                    str(country_info["database"]): {"data": {"schemas": "all"}}
                     for country_info in countries.values()
                 },
-            )
+            },
+            **{
+                str(country_info["group"]): dict(
+                    {
+                        str(country_info["database"]): {"data": {"schemas": "all"}},
+                    },
+                    **{
+                        str(country_other["database"]): {"data": {"schemas": "none"}}
+                        for country_other in countries.values()
+                        if country_info["group"] != country_other["group"]
+                    },
+                )
+                for country_info in countries.values()
+            },
         )
-        self.mb.put("/api/permissions/graph", json=permissions)
+        update_graph(self.mb, "/api/permissions/graph", permissions)
 
         # Collection permissions
-        collection_permissions = self.mb.get("/api/collection/graph").json()
-        collection_permissions["groups"].update(
-            dict(
-                {
-                    str(all_users_id): {
-                        str(country_info["collection"]): "none"
-                        for country_info in countries.values()
-                    },
-                    str(global_group_id): {
-                        str(country_info["collection"]): "read"
-                        for country_info in countries.values()
-                    },
+        collection_permissions = dict(
+            {
+                str(all_users_id): {
+                    str(country_info["collection"]): "none"
+                    for country_info in countries.values()
                 },
-                **{
-                    str(country_info["group"]): dict(
-                        {
-                            str(country_info["collection"]): "read",
-                        },
-                        **{
-                            str(country_other["collection"]): "none"
-                            for country_other in countries.values()
-                            if country_info["group"] != country_other["group"]
-                        },
-                    )
+                str(global_group_id): {
+                    str(country_info["collection"]): "read"
                     for country_info in countries.values()
                 },
-            )
+            },
+            **{
+                str(country_info["group"]): dict(
+                    {
+                        str(country_info["collection"]): "read",
+                    },
+                    **{
+                        str(country_other["collection"]): "none"
+                        for country_other in countries.values()
+                        if country_info["group"] != country_other["group"]
+                    },
+                )
+                for country_info in countries.values()
+            },
         )
 
-        self.mb.put("/api/collection/graph", json=collection_permissions)
+        update_graph(self.mb, "/api/collection/graph", collection_permissions)
 
     def set_up_dashboard(
         self,
         dashboard_name=None,
         description=None,
         cards=[],
+        dashcards=(),
         country=None,
         database_id=None,
         collection_id=None,
@@ -508,103 +700,18 @@ class MetabaseInitializer(object):
 
         log.info("Adding {} cards".format(dashboard_name))
 
-        col = 0
-        row = 0
-        row_height = 4
-        ordered_cards = self.mb.get("/api/dashboard/{}".format(dashboard_id)).json()[
-            "ordered_cards"
-        ]
-        cards_is = {card["card_id"]: card["id"] for card in ordered_cards}
-        cards_add = []
-        cards_update = []
-        cards_should = []
-        # TODO: delete description if it is None but a card exists
+        layout = DashboardLayout(self._total_cols)
         if description is not None:
-            description_card = next(
-                (card for card in ordered_cards if card["card_id"] is None), None
-            )
-            if not description_card:
-                description_card = self.mb.post(
-                    "/api/dashboard/{}/cards".format(dashboard_id),
-                    json={"cardId": None},
-                ).json()
-            dashcard = {
-                "id": description_card["id"],
-                "card_id": None,
-                "parameter_mappings": [],
-                "series": [],
-                "visualization_settings": {
-                    "virtual_card": {
-                        "archived": False,
-                        "dataset_query": {},
-                        "name": None,
-                        "display": "text",
-                        "visualization_settings": {},
-                    },
-                    "text": description,
-                },
-                "dashboard_id": dashboard_id,
-                "size_x": 4,
-                "size_y": 4,
-                "col": col,
-                "row": row,
-            }
-            col += 4
-            row += 4
-            cards_should.append(dashcard["card_id"])
-            cards_update.append(dashcard)
-
+            layout.add_text(description)
         for card in cards:
             if "id" in card:
                 card_id = card["id"]
             else:
                 card_id = self.create("card", card["name"], extra_data=card)
-            width = min(card.get("width", 4), self._total_cols)
-            height = card.get("height", 4)
-            if width + col > self._total_cols:
-                col = 0
-                row += row_height
-                row_height = height
-            else:
-                row_height = max(height, row_height)
-            dashcard = {
-                "col": col,
-                "row": row,
-                "size_x": width,
-                "size_y": height,
-            }
-            cards_should.append(card_id)
-            if card_id not in cards_is:
-                dashcard["cardId"] = card_id
-                cards_add.append(dashcard)
-            else:
-                dashcard["card_id"] = card_id
-                dashcard["id"] = cards_is[card_id]
-                cards_update.append(dashcard)
-
-            col += width
-
-        cards_delete = [
-            dashcard_id
-            for card_id, dashcard_id in cards_is.items()
-            if card_id not in cards_should
-        ]
-        for dashcard_id in cards_delete:
-            self.mb.delete(
-                "/api/dashboard/{}/cards?dashcardId={}".format(
-                    dashboard_id, dashcard_id
-                )
-            )
-        for dashcard in cards_add:
-            self.mb.post(
-                "/api/dashboard/{}/cards".format(dashboard_id),
-                json=dashcard,
-            )
-        if cards_update:
-            self.mb.put(
-                "/api/dashboard/{}/cards".format(dashboard_id),
-                json={"cards": cards_update},
-            )
+            layout.add_card(card_id, card.get("width", 4), card.get("height", 4))
+        for dashcard in dashcards:
+            layout.place(**dashcard)
+        sync_dashcards(self.mb, dashboard_id, layout.dashcards)
         return dashboard_id
 
     def set_up_account(self, country=None, database_id=34, collection_id=4):
@@ -734,57 +841,42 @@ class MetabaseInitializer(object):
             collection_position=4,
         )
 
-    def set_up_sectors(self, global_database_id, global_collection_id):
-        sectors = {}
-        for sector_name in config.sectors:
-            log.info("Adding sector {}".format(sector_name))
-            sectors[sector_name] = {}
-            collection_id = self.create(
-                "collection",
-                "Sector: {}".format(sector_name),
-                extra_data={
-                    "color": "#509EE3",
-                },
-            )
-            sectors[sector_name]["collection"] = collection_id
-            card_factory = SectorCardFactory(
-                sector_name, self.mb, global_database_id, collection_id
-            )
-            cards = {
-                "accumulated_assessments": card_factory.accumulated_assessments,
-                "new_assessments_per_month": card_factory.new_assessments_per_month,
-                "completion_of_assessments": card_factory.completion_of_assessments,
-                "top_tools_by_number_of_assessments": card_factory.top_tools_by_number_of_assessments,
-                "accumulated_assessments_over_time": card_factory.accumulated_assessments_over_time,
-                "accumulated_number_of_users": card_factory.accumulated_number_of_users,
-            }
-            for card_token, card in cards.items():
-                cards[card_token]["id"] = self.create(
-                    "card", card["name"], extra_data=card
-                )
+    def set_up_sector(self, sector_name, global_database_id):
+        log.info("Adding sector {}".format(sector_name))
+        collection_id = self.create(
+            "collection",
+            "Sector: {}".format(sector_name),
+            extra_data={
+                "color": "#509EE3",
+            },
+        )
+        sector = {"collection": collection_id}
+        card_factory = SectorCardFactory(
+            sector_name, self.mb, global_database_id, collection_id
+        )
+        cards = {
+            "accumulated_assessments": card_factory.accumulated_assessments,
+            "new_assessments_per_month": card_factory.new_assessments_per_month,
+            "completion_of_assessments": card_factory.completion_of_assessments,
+            "top_tools_by_number_of_assessments": card_factory.top_tools_by_number_of_assessments,
+            "accumulated_assessments_over_time": card_factory.accumulated_assessments_over_time,
+            "accumulated_number_of_users": card_factory.accumulated_number_of_users,
+        }
+        for card_token, card in cards.items():
+            cards[card_token]["id"] = self.create("card", card["name"], extra_data=card)
 
-            sectors[sector_name]["cards"] = cards
-            sector_dashboard_id = self.set_up_dashboard(
-                dashboard_name="Assessments ({})".format(sector_name),
-                cards=list(cards.values())[:-2],
-                database_id=global_database_id,
-                collection_id=collection_id,
-                collection_position=1,
-            )
-            self.mb.post(
-                "/api/dashboard/{}/cards".format(sector_dashboard_id),
-                json={
-                    "cardId": cards["accumulated_assessments_over_time"]["id"],
+        sector["cards"] = cards
+        self.set_up_dashboard(
+            dashboard_name="Assessments ({})".format(sector_name),
+            cards=list(cards.values())[:-2],
+            dashcards=[
+                {
+                    "card_id": cards["accumulated_assessments_over_time"]["id"],
                     "col": 4,
                     "row": 4,
                     "size_x": 8,
                     "size_y": 4,
-                    "series": [
-                        {
-                            "id": cards["accumulated_number_of_users"]["id"],
-                            "display": "line",
-                        },
-                    ],
+                    "series": [cards["accumulated_number_of_users"]["id"]],
                     "visualization_settings": {
                         "graph.show_trendline": False,
                         "graph.y_axis.title_text": "Number of Assessments/Users",
@@ -809,15 +901,17 @@ class MetabaseInitializer(object):
                         "graph.dimensions": ["start_date"],
                         "stackable.stack_type": None,
                     },
-                },
-            )
-
-        overview_dashboard_id = self.set_up_dashboard(
-            dashboard_name="Sectors Overview Dashboard",
+                }
+            ],
             database_id=global_database_id,
-            collection_id=global_collection_id,
-            collection_position=5,
+            collection_id=collection_id,
+            collection_position=1,
         )
+        return sector
+
+    def set_up_sectors_overview(
+        self, sectors, global_database_id, global_collection_id
+    ):
         overview_cards = [
             {
                 "token": "accumulated_assessments_over_time",
@@ -830,13 +924,14 @@ class MetabaseInitializer(object):
                 "graph.dimensions": ["completion", "count"],
             },
         ]
+        dashcards = []
         for idx, card_info in enumerate(overview_cards):
             combined_card = None
             for sector_name, sector_info in sectors.items():
                 next_card = sector_info["cards"][card_info["token"]]
                 if combined_card is None:
                     combined_card = {
-                        "cardId": next_card["id"],
+                        "card_id": next_card["id"],
                         "col": 0,
                         "row": idx * 8,
                         "size_x": self._total_cols,
@@ -859,21 +954,21 @@ class MetabaseInitializer(object):
                         },
                     }
                 else:
-                    combined_card["series"].append(
-                        {
-                            "id": next_card["id"],
-                        }
-                    )
+                    combined_card["series"].append(next_card["id"])
                     combined_card["visualization_settings"]["series_settings"][
                         "{} ({})".format(card_info["base_title"], sector_name)
                     ] = {
                         "title": sector_name,
                     }
-            self.mb.post(
-                "/api/dashboard/{}/cards".format(overview_dashboard_id),
-                json=combined_card,
-            )
-        return sectors
+            if combined_card is not None:
+                dashcards.append(combined_card)
+        self.set_up_dashboard(
+            dashboard_name="Sectors Overview Dashboard",
+            dashcards=dashcards,
+            database_id=global_database_id,
+            collection_id=global_collection_id,
+            collection_position=5,
+        )
 
     def set_up_inrs(self, country=None, database_id=34, collection_id=3):
         card_factory = CardFactory(self.mb, database_id, collection_id, country=country)
@@ -889,19 +984,11 @@ class MetabaseInitializer(object):
         for card_token, card in cards.items():
             cards[card_token]["id"] = self.create("card", card["name"], extra_data=card)
 
-        dashboard_id = self.set_up_dashboard(
-            dashboard_name="INRS",
-            cards=list(cards.values()),
-            country=country,
-            database_id=database_id,
-            collection_id=collection_id,
-            collection_position=5,
-        )
         combined_card = None
         for idx, card in enumerate(cards.values()):
             if combined_card is None:
                 combined_card = {
-                    "cardId": card["id"],
+                    "card_id": card["id"],
                     "col": 0,
                     "row": 4,
                     "size_x": self._total_cols,
@@ -921,63 +1008,44 @@ class MetabaseInitializer(object):
                     },
                 }
             else:
-                combined_card["series"].append(
-                    {
-                        "id": card["id"],
-                    }
-                )
-        self.mb.post(
-            "/api/dashboard/{}/cards".format(dashboard_id),
-            json=combined_card,
+                combined_card["series"].append(card["id"])
+        self.set_up_dashboard(
+            dashboard_name="INRS",
+            cards=list(cards.values()),
+            dashcards=[combined_card],
+            country=country,
+            database_id=database_id,
+            collection_id=collection_id,
+            collection_position=5,
         )
 
     def set_up_countries_overview(self, global_database_id, global_collection_id):
-        overview_dashboard_countryid = self.set_up_dashboard(
+        card_factory = CardFactory(self.mb, global_database_id, global_collection_id)
+        dashcards = []
+        for row, card in enumerate(
+            [
+                card_factory.top_assessments_by_country,
+                card_factory.accumulated_assessments_per_country,
+                card_factory.registered_users_per_country,
+            ]
+        ):
+            dashcards.append(
+                {
+                    "card_id": self.create("card", card["name"], extra_data=card),
+                    "col": 0,
+                    "row": row * 4,
+                    "size_x": 18,
+                    "size_y": 4,
+                }
+            )
+        self.set_up_dashboard(
             dashboard_name="Countries Overview Dashboard",
+            dashcards=dashcards,
             database_id=global_database_id,
             collection_id=global_collection_id,
             collection_position=6,
         )
 
-        card_factory = CardFactory(self.mb, global_database_id, global_collection_id)
-        card = card_factory.top_assessments_by_country
-        card_id = self.create("card", card["name"], extra_data=card)
-        self.mb.post(
-            "/api/dashboard/{}/cards".format(overview_dashboard_countryid),
-            json={
-                "cardId": card_id,
-                "col": 0,
-                "row": 0,
-                "size_x": 18,
-                "size_y": 4,
-            },
-        )
-        card = card_factory.accumulated_assessments_per_country
-        card_id = self.create("card", card["name"], extra_data=card)
-        self.mb.post(
-            "/api/dashboard/{}/cards".format(overview_dashboard_countryid),
-            json={
-                "cardId": card_id,
-                "col": 0,
-                "row": 4,
-                "size_x": 18,
-                "size_y": 4,
-            },
-        )
-
-        card = card_factory.registered_users_per_country
-        card_id = self.create("card", card["name"], extra_data=card)
-        self.mb.post(
-            "/api/dashboard/{}/cards".format(overview_dashboard_countryid),
-            json={
-                "cardId": card_id,
-                "col": 0,
-                "row": 8,
-                "size_x": 18,
-                "size_y": 4,
-            },
-        )
-
     def set_up_ldap(self, countries, global_group_id):
         log.info("Setting up LDAP")
         group_mappings = {
@@ -1008,26 +1076,43 @@ class MetabaseInitializer(object):
 
     @property
     def existing_items(self):
-        if not self._existing_items:
-            self._existing_items = {}
-            self._existing_items["groups"] = {
-                group["name"]: group["id"]
-                for group in self.mb.get("/api/permissions/group").json()
-            }
-            self._existing_items["databases"] = {
-                db["name"]: db["id"]
-                for db in self.mb.get("/api/database").json()["data"]
-            }
-            self._existing_items["collections"] = {
-                collection["name"]: collection["id"]
-                for collection in self.mb.get("/api/collection").json()
-            }
-            self._existing_items["dashboards"] = {
-                dashboard["name"]: dashboard["id"]
-                for dashboard in self.mb.get("/api/dashboard").json()
-            }
-            self._existing_items["cards"] = {
-                card["name"]: card["id"] for card in self.mb.get("/api/card").json()
-            }
-
+        with self._existing_items_lock:
+            if not self._existing_items:
+                self._existing_items = self._get_existing_items()
         return self._existing_items
+
+    @property
+    def fingerprints(self):
+        """Fingerprints of the existing cards, collections and dashboards by name,
+        loaded together with `existing_items`"""
+        with self._existing_items_lock:
+            if not self._existing_items:
+                self._existing_items = self._get_existing_items()
+        return self._fingerprints
+
+    def _get_existing_items(self):
+        existing_items = {}
+        # The listings contain complete object definitions (the card listing
+        # can be many megabytes), only names and ids and the fields needed for
+        # the fingerprints are decoded.
+        existing_items["groups"] = {
+            group["name"]: group["id"]
+            for group in self.mb.get_items("/api/permissions/group")
+        }
+        existing_items["databases"] = {
+            db["name"]: db["id"]
+            for db in self.mb.get_items("/api/database", prefix="data.item")
+        }
+        fingerprints = {}
+        for obj_type in ["collection", "dashboard", "card"]:
+            existing_items[obj_type + "s"] = {}
+            fingerprints[obj_type + "s"] = {}
+            for obj in self.mb.get_items(
+                "/api/{}".format(obj_type),
+                keys=("id",) + compared_fields[obj_type],
+            ):
+                existing_items[obj_type + "s"][obj["name"]] = obj["id"]
+                fingerprints[obj_type + "s"][obj["name"]] = fingerprint(obj_type, obj)
+        self._fingerprints = fingerprints
+
+        return existing_items
@@ -0,0 +1,128 @@
+from collections import defaultdict
+
+import json
+import logging
+import re
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+def endpoint_template(endpoint):
+    """Collapse ids in an endpoint, e.g. /api/card/42?x=1 -> /api/card/:id"""
+    path = endpoint.partition("?")[0].rstrip("/")
+    return re.sub(r"/\d+(?=/|$)", "/:id", path)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+class RequestStats(object):
+    """Records every HTTP exchange with metabase and summarizes them per endpoint.
+
+    `record` is called by the metabase clients for each request that is actually
+    sent, including retries and authentication, but not for cached responses.
+    The `observers` are called with every recorded request, in the thread that
+    sent it.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.observers = []
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        method,
+        endpoint,
+        status,
+        latency,
+        request_bytes=0,
+        response_bytes=0,
+        bytes_saved=0,
+    ):
+        entry = {
+            "method": method,
+            "endpoint": endpoint_template(endpoint),
+            "status": status,
+            "latency": latency,
+            "request_bytes": request_bytes,
+            "response_bytes": response_bytes,
+            "bytes_saved": bytes_saved,
+        }
+        with self._lock:
+            self.requests.append(entry)
+        for observer in list(self.observers):
+            observer(entry)
+
+    def __len__(self):
+        return len(self.requests)
+
+    def summary(self):
+        """Per endpoint statistics, slowest total time first"""
+        with self._lock:
+            requests = list(self.requests)
+        grouped = defaultdict(list)
+        for entry in requests:
+            grouped[(entry["method"], entry["endpoint"])].append(entry)
+        summary = []
+        for (method, endpoint), entries in grouped.items():
+            latencies = sorted(entry["latency"] for entry in entries)
+            summary.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": len(entries),
+                    "errors": len(
+                        [
+                            entry
+                            for entry in entries
+                            if entry["status"] is None or entry["status"] >= 400
+                        ]
+                    ),
+                    "p50": percentile(latencies, 0.5),
+                    "p95": percentile(latencies, 0.95),
+                    "max": latencies[-1],
+                    "total": sum(latencies),
+                    "request_bytes": sum(entry["request_bytes"] for entry in entries),
+                    "response_bytes": sum(entry["response_bytes"] for entry in entries),
+                    "bytes_saved": sum(entry["bytes_saved"] for entry in entries),
+                }
+            )
+        summary.sort(key=lambda row: row["total"], reverse=True)
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        lines = [
+            "{:<7} {:<45} {:>6} {:>8} {:>8} {:>8} {:>9}".format(
+                "method", "endpoint", "count", "p50", "p95", "max", "total"
+            )
+        ]
+        for row in summary:
+            lines.append(
+                "{method:<7} {endpoint:<45} {count:>6} {p50:>8.3f} {p95:>8.3f} "
+                "{max:>8.3f} {total:>9.2f}".format(**row)
+            )
+        lines.append(
+            "{} requests, {:.2f}s in total, {:.1f} kB saved by compression".format(
+                sum(row["count"] for row in summary),
+                sum(row["total"] for row in summary),
+                sum(row["bytes_saved"] for row in summary) / 1024,
+            )
+        )
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as stats_file:
+            json.dump(
+                {"endpoints": self.summary(), "requests": self.requests},
+                stats_file,
+                indent=2,
+            )
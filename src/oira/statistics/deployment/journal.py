@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Options that change how a run goes, but not what it sets up
+run_options = (
+    "jobs",
+    "resume",
+    "stats_json",
+    "profile",
+    "profile_memory",
+    "plan",
+    "apply",
+    "record_cassette",
+    "replay_cassette",
+    "replay_latency",
+    "metabase_pool_size",
+    "metabase_timeout",
+    "metabase_retries",
+    "metabase_retry_budget",
+    "metabase_max_concurrency",
+    "metabase_min_concurrency",
+    "metabase_cache",
+    "metabase_compress_requests",
+    "database_sync_timeout",
+    "database_sync_concurrency",
+    "metadata_state",
+    "metadata_rescan_interval",
+)
+
+
+def digest(value):
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=repr)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def run_fingerprint(args):
+    """Hash of the options and of the code and resources of this package, which
+    decide what every step sets up"""
+    sha = hashlib.sha1(
+        digest(
+            {
+                key: value
+                for key, value in sorted(vars(args).items())
+                if key not in run_options
+            }
+        ).encode("utf-8")
+    )
+    package = os.path.dirname(os.path.abspath(__file__))
+    for directory in (package, os.path.join(package, "resources")):
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not name.endswith((".pyc", ".pyo")):
+                with open(path, "rb") as source:
+                    sha.update(name.encode("utf-8"))
+                    sha.update(source.read())
+    return sha.hexdigest()
+
+
+class Journal(object):
+    """The set up steps of a run that completed, with a hash of their inputs and
+    their result, to skip them when the run is resumed.
+
+    The journal is written after every completed step. It only applies to runs
+    with the same `version`, see `run_fingerprint`; otherwise all steps run
+    again.
+    """
+
+    def __init__(self, path, version, steps=None):
+        self.path = path
+        self.version = version
+        self.steps = steps or {}
+        self.resumed = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, version):
+        if not os.path.exists(path):
+            return cls(path, version)
+        with open(path) as journal_file:
+            data = json.load(journal_file)
+        if data.get("version") != version:
+            log.info(
+                "The code or options changed since {} was written, running all "
+                "steps".format(path)
+            )
+            return cls(path, version)
+        log.info("Resuming with {} completed steps".format(len(data["steps"])))
+        return cls(path, version, data["steps"])
+
+    @staticmethod
+    def inputs(args, kwargs):
+        return digest([args, kwargs])
+
+    def lookup(self, name, inputs):
+        """Return (True, result) if the step already completed with these inputs,
+        otherwise (False, None)"""
+        with self._lock:
+            step = self.steps.get(name)
+            if step is None or step["inputs"] != inputs:
+                return False, None
+            self.resumed.append(name)
+            return True, step["result"]
+
+    def record(self, name, inputs, result):
+        try:
+            json.dumps(result)
+        except TypeError:
+            log.debug("Not journaling {}, its result can't be saved".format(name))
+            return
+        with self._lock:
+            self.steps[name] = {"inputs": inputs, "result": result}
+            self._save()
+
+    def _save(self):
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as journal_file:
+            json.dump({"version": self.version, "steps": self.steps}, journal_file)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,215 @@
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def text_settings(text):
+    """Visualization settings of a virtual text card"""
+    return {
+        "virtual_card": {
+            "archived": False,
+            "dataset_query": {},
+            "name": None,
+            "display": "text",
+            "visualization_settings": {},
+        },
+        "text": text,
+    }
+
+
+class DashboardLayout(object):
+    """The complete list of dashcards that a dashboard should have.
+
+    Cards added without a position flow from left to right in rows of
+    `total_cols` columns.
+    """
+
+    def __init__(self, total_cols=16):
+        self.total_cols = total_cols
+        self.dashcards = []
+        self.col = 0
+        self.row = 0
+        self.row_height = 4
+
+    def place(
+        self,
+        card_id,
+        col,
+        row,
+        size_x=4,
+        size_y=4,
+        series=(),
+        visualization_settings=None,
+    ):
+        """Add a dashcard at a fixed position; `series` are the ids of the cards
+        shown together with `card_id`"""
+        self.dashcards.append(
+            {
+                "card_id": card_id,
+                "col": col,
+                "row": row,
+                "size_x": size_x,
+                "size_y": size_y,
+                "series": list(series),
+                "visualization_settings": visualization_settings or {},
+            }
+        )
+
+    def add_text(self, text, size_x=4, size_y=4):
+        """Add a text card at the current position and continue below it"""
+        self.place(
+            None,
+            self.col,
+            self.row,
+            size_x,
+            size_y,
+            visualization_settings=text_settings(text),
+        )
+        self.col += size_x
+        self.row += size_y
+
+    def add_card(self, card_id, width=4, height=4):
+        width = min(width, self.total_cols)
+        if width + self.col > self.total_cols:
+            self.col = 0
+            self.row += self.row_height
+            self.row_height = height
+        else:
+            self.row_height = max(height, self.row_height)
+        self.place(card_id, self.col, self.row, width, height)
+        self.col += width
+
+
+def dashcard_key(dashcard):
+    """What identifies a dashcard: its card, the cards of its series and its
+    position"""
+    series = [
+        card["id"] if isinstance(card, dict) else card
+        for card in dashcard.get("series") or []
+    ]
+    return (dashcard["card_id"], tuple(series), dashcard["col"], dashcard["row"])
+
+
+def same_dashcard(existing, dashcard):
+    return (
+        dashcard_key(existing) == dashcard_key(dashcard)
+        and all(existing.get(key) == dashcard[key] for key in ("size_x", "size_y"))
+        and (existing.get("visualization_settings") or {})
+        == dashcard["visualization_settings"]
+    )
+
+
+def diff_dashcards(existing, dashcards):
+    """Match the wanted `dashcards` with the `existing` ones of a dashboard.
+
+    Dashcards with the same card, series and position are matched first, the
+    remaining ones by their card only, so that a moved card or a changed series
+    is updated in place. Existing dashcards left over, e.g. duplicates of a
+    combined card, are removed.
+
+    Returns the ids of the dashcards to delete, the dashcards to add and the
+    changed dashcards, with the id of the existing dashcard they replace.
+    """
+    unmatched = list(existing)
+    matches = {}
+    for idx, dashcard in enumerate(dashcards):
+        match = next(
+            (
+                candidate
+                for candidate in unmatched
+                if dashcard_key(candidate) == dashcard_key(dashcard)
+            ),
+            None,
+        )
+        if match is not None:
+            unmatched.remove(match)
+            matches[idx] = match
+    for idx, dashcard in enumerate(dashcards):
+        if idx in matches:
+            continue
+        match = next(
+            (
+                candidate
+                for candidate in unmatched
+                if candidate["card_id"] == dashcard["card_id"]
+            ),
+            None,
+        )
+        if match is not None:
+            unmatched.remove(match)
+            matches[idx] = match
+
+    add = []
+    update = []
+    for idx, dashcard in enumerate(dashcards):
+        match = matches.get(idx)
+        if match is None:
+            add.append(dashcard)
+        elif not same_dashcard(match, dashcard):
+            update.append(
+                dict(
+                    dashcard,
+                    id=match["id"],
+                    parameter_mappings=match.get("parameter_mappings") or [],
+                )
+            )
+    matched_keys = {dashcard_key(match) for match in matches.values()}
+    duplicates = [
+        dashcard for dashcard in unmatched if dashcard_key(dashcard) in matched_keys
+    ]
+    if duplicates:
+        log.warning("Removing {} duplicate dashcards".format(len(duplicates)))
+    return [dashcard["id"] for dashcard in unmatched], add, update
+
+
+def sync_dashcards(mb, dashboard_id, dashcards):
+    """Make the dashcards of a dashboard match `dashcards`.
+
+    Metabase only adds and removes single dashcards, but updates all changed
+    ones at once, so this sends a DELETE per removed and a POST per added card
+    and at most one PUT. Dashboards that are already complete only cost the GET
+    of their dashcards.
+    """
+    existing = mb.get("/api/dashboard/{}".format(dashboard_id)).json()["ordered_cards"]
+    delete, add, update = diff_dashcards(existing, dashcards)
+    url = "/api/dashboard/{}/cards".format(dashboard_id)
+    for dashcard_id in delete:
+        mb.delete("{}?dashcardId={}".format(url, dashcard_id))
+    for dashcard in add:
+        mb.post(
+            url,
+            json={
+                "cardId": dashcard["card_id"],
+                "col": dashcard["col"],
+                "row": dashcard["row"],
+                "size_x": dashcard["size_x"],
+                "size_y": dashcard["size_y"],
+                "series": [{"id": card_id} for card_id in dashcard["series"]],
+                "visualization_settings": dashcard["visualization_settings"],
+                "parameter_mappings": [],
+            },
+        )
+    if update:
+        mb.put(
+            url,
+            json={
+                "cards": [
+                    dict(
+                        dashcard,
+                        series=[{"id": card_id} for card_id in dashcard["series"]],
+                    )
+                    for dashcard in update
+                ]
+            },
+        )
+    log.info(
+        "Dashboard {}: {} dashcards removed, {} added, {} updated, {} unchanged"
+        "".format(
+            dashboard_id,
+            len(delete),
+            len(add),
+            len(update),
+            len(dashcards) - len(add) - len(update),
+        )
+    )
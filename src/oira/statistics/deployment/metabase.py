@@ -1,56 +1,697 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from metabase_api import Metabase_API
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
+import gzip
+import ijson
 import json
 import logging
+import random
 import requests
+import threading
+import time
 
 
 log = logging.getLogger(__name__)
 
 
+class MetabaseUnavailable(Exception):
+    """Raised without contacting metabase while the circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+    """Fails fast once metabase looks down.
+
+    After `threshold` consecutive failures (5xx, timeouts, connection errors) the
+    breaker opens and every request raises MetabaseUnavailable for `cooldown`
+    seconds. After that a single trial request is let through; if it succeeds the
+    breaker closes again, otherwise it stays open for another cooldown.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown:
+                raise MetabaseUnavailable(
+                    "Metabase failed {} times in a row, not sending requests for "
+                    "{}s".format(self.failures, self.cooldown)
+                )
+            # half-open: let one request through and restart the cooldown, so
+            # that concurrent callers keep failing fast until it has returned
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.error(
+                        "Metabase failed {} times in a row, opening circuit "
+                        "breaker".format(self.failures)
+                    )
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy(object):
+    """Decides whether and when a failed request to metabase is sent again.
+
+    Requests are retried with exponential backoff and full jitter on 5xx
+    responses, timeouts and connection errors. Non-idempotent verbs are only
+    retried if the request cannot have been processed: when no connection could
+    be established (`error="connect"`) or when metabase answered with one of the
+    `safe_errors`. All requests of a run share one retry `budget`.
+    """
+
+    idempotent_methods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+    # Metabase sometimes fails to insert new objects with a "duplicate key" error
+    # that goes away by itself.
+    safe_errors = ("duplicate key",)
+
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=30, budget=100):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retries = 0
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def is_failure(self, status_code):
+        return status_code >= 500
+
+    def is_retryable(self, method, status_code=None, message="", error=None):
+        if error == "connect":
+            return True
+        if status_code is not None and any(
+            safe_error in message for safe_error in self.safe_errors
+        ):
+            return True
+        if method.upper() not in self.idempotent_methods:
+            return False
+        return error == "network" or (
+            status_code is not None and self.is_failure(status_code)
+        )
+
+    def next_delay(self, method, attempt, status_code=None, message="", error=None):
+        """Return the number of seconds to wait before retrying, or None if the
+        request must not be retried."""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        if not self.is_retryable(
+            method, status_code=status_code, message=message, error=error
+        ):
+            return None
+        with self._lock:
+            if self.retries >= self.budget:
+                if not self.exhausted:
+                    log.warning("Retry budget of {} exhausted".format(self.budget))
+                    self.exhausted = True
+                return None
+            self.retries += 1
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+def error_message(result):
+    try:
+        info = result.json()
+    except ValueError:
+        return result.text
+    if not isinstance(info, dict):
+        return ""
+    return str(info.get("message") or info.get("errors") or "")
+
+
+class _PendingFetch(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.stale = False
+
+
+class ResponseCache(object):
+    """Opt-in cache for GET responses of a single run.
+
+    Responses are keyed by path, query string and params. Identical GETs that
+    are sent while the first one is still in flight wait for its response instead
+    of sending their own request. Any write to a path drops the cached entries of
+    that path, of the paths above it (e.g. the listings) and below it. Entries
+    expire after `ttl` seconds and the least recently used ones are evicted once
+    there are more than `max_entries`.
+    """
+
+    # Paths that must always be fetched from metabase, e.g. because they are
+    # polled until they change
+    uncacheable = ("/api/session", "/api/user/current", "/api/util/")
+    # Writes to these paths change what metabase returns for other paths
+    related = {
+        "/api/field": ("/api/database", "/api/table"),
+        "/api/table": ("/api/database",),
+        "/api/permissions/group": ("/api/permissions/graph",),
+        "/api/collection": ("/api/collection/graph",),
+    }
+
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def split(endpoint):
+        path, _, query = endpoint.partition("?")
+        return path.rstrip("/"), query
+
+    def key(self, endpoint, params=None):
+        path, query = self.split(endpoint)
+        query = "&".join(sorted(filter(None, query.split("&"))))
+        return (path, query, json.dumps(params, sort_keys=True, default=str))
+
+    def cacheable(self, endpoint):
+        return not self.split(endpoint)[0].startswith(self.uncacheable)
+
+    def fetch(self, endpoint, params, load):
+        """Return the cached response for a GET or call `load` to get it"""
+        key = self.key(endpoint, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _PendingFetch()
+                self.misses += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = load()
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+                result = pending.result
+                if result is not None and result.ok and not pending.stale:
+                    self._entries[key] = (time.monotonic(), result)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            pending.event.set()
+        return pending.result
+
+    def invalidate(self, endpoint):
+        """Drop everything that a write to `endpoint` may have changed."""
+        path = self.split(endpoint)[0]
+        prefixes = [path]
+        for prefix, related in self.related.items():
+            if path == prefix or path.startswith(prefix + "/"):
+                prefixes.extend(related)
+
+        def affected(key):
+            cached = key[0]
+            return any(
+                cached == prefix
+                or cached.startswith(prefix + "/")
+                or prefix.startswith(cached + "/")
+                for prefix in prefixes
+            )
+
+        with self._lock:
+            for key in [key for key in self._entries if affected(key)]:
+                del self._entries[key]
+                self.invalidations += 1
+            for key, pending in self._pending.items():
+                if affected(key):
+                    pending.stale = True
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.coalesced + self.misses
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    def report(self):
+        return (
+            "{hits} cached and {coalesced} coalesced of {total} GET requests "
+            "({rate:.0%} hit rate), {invalidations} entries invalidated".format(
+                hits=self.hits,
+                coalesced=self.coalesced,
+                total=self.hits + self.coalesced + self.misses,
+                rate=self.hit_rate,
+                invalidations=self.invalidations,
+            )
+        )
+
+
+class AdaptiveConcurrency(object):
+    """Adjusts the number of requests in flight to how well metabase copes.
+
+    Works like AIMD congestion control: after every window of completed requests
+    the limit grows by one if latency and error rate look healthy, and is halved
+    if the error rate exceeds `error_threshold` or the average latency exceeds
+    `latency_tolerance` times the best window average seen so far (metabase slows
+    down a lot while it syncs databases and scans field values). The limit stays
+    between `floor` and `ceiling`.
+    """
+
+    def __init__(
+        self,
+        floor=1,
+        ceiling=16,
+        initial=None,
+        latency_tolerance=2.0,
+        error_threshold=0.05,
+        min_samples=10,
+    ):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.limit = min(self.ceiling, max(self.floor, initial or self.floor))
+        self.latency_tolerance = latency_tolerance
+        self.error_threshold = error_threshold
+        self.min_samples = min_samples
+        self.in_flight = 0
+        self.baseline = None
+        self.adjustments = 0
+        self.lowest = self.highest = self.limit
+        self._samples = []
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def observe(self, latency, failed):
+        with self._condition:
+            self._samples.append((latency, failed))
+            if len(self._samples) < max(self.min_samples, self.limit):
+                return
+            samples, self._samples = self._samples, []
+            average = sum(latency for latency, failed in samples) / len(samples)
+            error_rate = len([1 for latency, failed in samples if failed]) / len(
+                samples
+            )
+            if self.baseline is None or average < self.baseline:
+                self.baseline = average
+            if (
+                error_rate > self.error_threshold
+                or average > self.baseline * self.latency_tolerance
+            ):
+                limit = max(self.floor, self.limit // 2)
+            else:
+                limit = min(self.ceiling, self.limit + 1)
+            if limit == self.limit:
+                return
+            log.info(
+                "Changing concurrency limit from {} to {} (average latency {:.3f}s, "
+                "best {:.3f}s, error rate {:.0%})".format(
+                    self.limit, limit, average, self.baseline, error_rate
+                )
+            )
+            self.limit = limit
+            self.adjustments += 1
+            self.lowest = min(self.lowest, limit)
+            self.highest = max(self.highest, limit)
+            self._condition.notify_all()
+
+    def report(self):
+        return (
+            "concurrency limit {} (between {} and {} during the run, {} "
+            "adjustments)".format(
+                self.limit, self.lowest, self.highest, self.adjustments
+            )
+        )
+
+
+def response_size(result, streamed=False):
+    if streamed:
+        # don't read a streamed body just to measure it
+        return int(result.headers.get("Content-Length") or 0)
+    return len(result.content)
+
+
+def response_savings(result, wire_bytes):
+    """Bytes saved by a compressed response body"""
+    if not result.headers.get("Content-Encoding"):
+        return 0
+    return max(0, len(result.content) - wire_bytes)
+
+
+def compress_json(kwargs, min_size, body_arg="data"):
+    """Replace the `json` argument of a request by a gzip compressed body.
+
+    Returns the new keyword arguments and the size of the uncompressed body, or
+    the unchanged arguments and None if the body is missing or too small to be
+    worth compressing.
+    """
+    if kwargs.get("json") is None:
+        return kwargs, None
+    body = json.dumps(kwargs["json"]).encode("utf-8")
+    if len(body) < min_size:
+        return kwargs, None
+    kwargs = dict(kwargs)
+    del kwargs["json"]
+    kwargs[body_arg] = gzip.compress(body)
+    kwargs["headers"] = dict(
+        kwargs.get("headers") or {},
+        **{"Content-Encoding": "gzip", "Content-Type": "application/json"}
+    )
+    return kwargs, len(body)
+
+
+def iter_items(stream, prefix="item", keys=("id", "name")):
+    """Incrementally decode the objects at `prefix` of a JSON document.
+
+    `prefix` uses ijson notation, e.g. "item" for the objects of a top level list
+    or "data.item" for a list in the "data" key. Only the values of `keys` are
+    kept, everything else is skipped while parsing.
+    """
+    wanted = {"{}.{}".format(prefix, key): key for key in keys}
+    item = None
+    builder = None
+    key = None
+    depth = 0
+    for path, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            # inside a nested value of one of the keys
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+                if depth == 0:
+                    item[key] = builder.value
+                    builder = None
+        elif path == prefix:
+            if event == "start_map":
+                item = {}
+            elif event == "end_map":
+                yield item
+                item = None
+        elif item is not None and path in wanted:
+            if event in _scalar_events:
+                item[wanted[path]] = value
+            elif event in ("start_map", "start_array"):
+                key = wanted[path]
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+
+
+_scalar_events = ("null", "boolean", "integer", "double", "number", "string")
+
+
 class OiraMetabase_API(Metabase_API):
+    def __init__(
+        self,
+        domain,
+        email=None,
+        password=None,
+        pool_size=10,
+        timeout=120,
+        retry_policy=None,
+        circuit_breaker=None,
+        cache=None,
+        stats=None,
+        compress_requests=False,
+        compress_min_size=1024,
+        adapter=None,
+        concurrency=None,
+        plan=None,
+        **kwargs
+    ):
+        # One session for the whole run, so that connections to metabase are kept
+        # alive and reused instead of being set up again for every request.
+        self.session = requests.Session()
+        if adapter is None:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.compress_requests = compress_requests
+        # whether metabase accepted a compressed request body yet
+        self._compression_accepted = False
+        self.compress_min_size = compress_min_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.cache = cache
+        self.stats = stats
+        self.plan = plan
+        self.skipped_validations = 0
+        self._lock = threading.RLock()
+        super().__init__(domain, email=email, password=password, **kwargs)
+
     def authenticate(self):
         """Get a Session ID"""
         conn_header = {"username": self.email, "password": self.password}
 
-        try:
-            res = requests.post(
-                self.domain + "/api/session", json=conn_header, timeout=15
-            )
-        except requests.exceptions.Timeout:
-            log.warn("Authentication timed out, retrying")
-            res = requests.post(
-                self.domain + "/api/session", json=conn_header, timeout=30
-            )
+        res = self._send_with_retries(
+            "POST",
+            lambda: self.send("POST", "/api/session", json=conn_header, timeout=15),
+        )
         if not res.ok:
             raise Exception(res)
 
         self.session_id = res.json()["id"]
         self.header = {"X-Metabase-Session": self.session_id}
+        self.session.headers.update(self.header)
 
-    def get(self, endpoint, **kwargs):
-        self.validate_session()
-        result = requests.get(self.domain + endpoint, headers=self.header, **kwargs)
-        self.check_error(result)
+    def validate_session(self):
+        """Get a new session ID if the previous one has expired.
+
+        Requests don't need this, `request` authenticates again when metabase
+        rejects the session. It is kept for the methods of Metabase_API.
+        """
+        res = self.get("/api/user/current", cache=False)
+        if not res.ok:
+            raise Exception(res)
+        return True
+
+    def send(self, method, endpoint, uncompressed_size=None, **kwargs):
+        """Send a single request, without retries or caching"""
+        if self.concurrency is None:
+            return self._send(method, endpoint, uncompressed_size, **kwargs)
+        with self.concurrency.slot():
+            start = time.perf_counter()
+            result = None
+            try:
+                result = self._send(method, endpoint, uncompressed_size, **kwargs)
+            finally:
+                self.concurrency.observe(
+                    time.perf_counter() - start,
+                    result is None or self.retry_policy.is_failure(result.status_code),
+                )
         return result
 
-    def post(self, endpoint, **kwargs):
-        self.validate_session()
-        result = requests.post(self.domain + endpoint, headers=self.header, **kwargs)
-        self.check_error(result)
+    def _send(self, method, endpoint, uncompressed_size, **kwargs):
+        start = time.perf_counter()
+        result = None
+        try:
+            result = self.session.request(method, self.domain + endpoint, **kwargs)
+        finally:
+            if self.stats is not None and result is None:
+                self.stats.record(method, endpoint, None, time.perf_counter() - start)
+            elif self.stats is not None:
+                request_bytes = len(result.request.body or b"")
+                bytes_saved = 0
+                if uncompressed_size is not None and result.status_code < 400:
+                    bytes_saved += uncompressed_size - request_bytes
+                if not kwargs.get("stream"):
+                    bytes_saved += response_savings(result, result.raw.tell())
+                self.stats.record(
+                    method,
+                    endpoint,
+                    result.status_code,
+                    time.perf_counter() - start,
+                    request_bytes=request_bytes,
+                    response_bytes=response_size(result, streamed=kwargs.get("stream")),
+                    bytes_saved=bytes_saved,
+                )
         return result
 
-    def put(self, endpoint, **kwargs):
-        self.validate_session()
-        result = requests.put(self.domain + endpoint, headers=self.header, **kwargs)
+    def _send_with_retries(self, method, send):
+        attempt = 0
+        while True:
+            self.circuit_breaker.check()
+            try:
+                result = send()
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                self.circuit_breaker.record_failure()
+                reason = getattr(e.args[0], "reason", None) if e.args else None
+                if isinstance(e, requests.exceptions.ConnectTimeout) or isinstance(
+                    reason, NewConnectionError
+                ):
+                    error = "connect"
+                else:
+                    error = "network"
+                delay = self.retry_policy.next_delay(method, attempt, error=error)
+                if delay is None:
+                    raise
+                reason = e
+            else:
+                if self.retry_policy.is_failure(result.status_code):
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()
+                if result.ok:
+                    return result
+                delay = self.retry_policy.next_delay(
+                    method,
+                    attempt,
+                    status_code=result.status_code,
+                    message=error_message(result),
+                )
+                if delay is None:
+                    return result
+                reason = "{} {}".format(result.status_code, result.reason)
+            attempt += 1
+            log.warning(
+                "{} request failed ({}), retry {} in {:.1f}s".format(
+                    method, reason, attempt, delay
+                )
+            )
+            time.sleep(delay)
+
+    def request(self, method, endpoint, cache=True, **kwargs):
+        if self.plan is not None:
+            # only reads reach metabase while planning
+            planned = self.plan.intercept(method, endpoint, kwargs.get("json"))
+            if planned is not None:
+                return planned
+        kwargs.setdefault("timeout", self.timeout)
+        plain_kwargs = kwargs
+        uncompressed_size = None
+        if self.compress_requests:
+            kwargs, uncompressed_size = compress_json(kwargs, self.compress_min_size)
+
+        def send():
+            # The session is trusted until metabase rejects it, instead of asking
+            # /api/user/current before every single request.
+            session_id = self.session_id
+            result = self.send(
+                method, endpoint, uncompressed_size=uncompressed_size, **kwargs
+            )
+            with self._lock:
+                self.skipped_validations += 1
+            if result.status_code == 401:
+                with self._lock:
+                    # another thread may have authenticated in the meantime
+                    if self.session_id == session_id:
+                        log.info("Session expired, authenticating again")
+                        self.authenticate()
+                result = self.send(
+                    method, endpoint, uncompressed_size=uncompressed_size, **kwargs
+                )
+            if uncompressed_size is not None:
+                if result.status_code < 400:
+                    self._compression_accepted = True
+                elif (
+                    result.status_code in (400, 415) and not self._compression_accepted
+                ):
+                    # Only the first compressed requests probe whether metabase
+                    # decodes them, later errors are about their content.
+                    log.warning(
+                        "Metabase rejected a compressed request body, sending "
+                        "request bodies uncompressed from now on"
+                    )
+                    self.compress_requests = False
+                    result = self.send(method, endpoint, **plain_kwargs)
+            return result
+
+        if self.cache is None:
+            result = self._send_with_retries(method, send)
+        elif (
+            method == "GET"
+            and cache
+            and self.cache.cacheable(endpoint)
+            and not kwargs.get("stream")
+        ):
+            result = self.cache.fetch(
+                endpoint,
+                kwargs.get("params"),
+                lambda: self._send_with_retries(method, send),
+            )
+        else:
+            try:
+                result = self._send_with_retries(method, send)
+            finally:
+                if method != "GET":
+                    self.cache.invalidate(endpoint)
         self.check_error(result)
+        if self.plan is not None:
+            self.plan.observe(endpoint, result)
         return result
 
+    def get(self, endpoint, **kwargs):
+        return self.request("GET", endpoint, **kwargs)
+
+    def get_items(self, endpoint, prefix="item", keys=("id", "name"), **kwargs):
+        """Iterate over the objects of a listing without loading the whole response.
+
+        Large listings like /api/card contain the complete definition of every
+        object; this only decodes the given `keys`, see `iter_items`. Raises
+        requests.HTTPError if metabase doesn't return the listing, callers
+        would otherwise take it for an empty one.
+        """
+        result = self.get(endpoint, stream=True, **kwargs)
+        try:
+            result.raise_for_status()
+            result.raw.decode_content = True
+            yield from iter_items(result.raw, prefix=prefix, keys=keys)
+        finally:
+            result.close()
+
+    def post(self, endpoint, **kwargs):
+        return self.request("POST", endpoint, **kwargs)
+
+    def put(self, endpoint, **kwargs):
+        return self.request("PUT", endpoint, **kwargs)
+
     def delete(self, endpoint, **kwargs):
-        self.validate_session()
-        result = requests.delete(self.domain + endpoint, headers=self.header, **kwargs)
-        self.check_error(result)
-        return result
+        return self.request("DELETE", endpoint, **kwargs)
 
     def check_error(self, result):
         if not result.ok:
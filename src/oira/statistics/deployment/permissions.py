@@ -0,0 +1,90 @@
+from .plan import flatten
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class PermissionGraphConflict(Exception):
+    """Raised if a permission graph keeps changing while we update it"""
+
+
+missing = object()
+
+
+def lookup(value, path):
+    """The entry of a permission graph at `path`, or `missing` if there is none.
+
+    If a value that isn't a dict is found before the end of `path`, e.g. "all"
+    for a whole database, that value is returned.
+    """
+    for key in path:
+        if value is None:
+            return missing
+        if not isinstance(value, dict):
+            return value
+        if key not in value:
+            return missing
+        value = value[key]
+    return missing if value is None else value
+
+
+def cell_matches(current, wanted):
+    """Whether the permissions of a group on an object already are `wanted`.
+
+    Only the entries in `wanted` are compared. Metabase leaves out the
+    permissions a group doesn't have, so a missing entry matches "none".
+    Granular permissions, e.g. per schema where a value for all schemas is
+    wanted, never match.
+    """
+    for path, value in flatten(wanted):
+        old = lookup(current, path)
+        if old is missing:
+            if value != "none":
+                return False
+        elif old != value:
+            return False
+    return True
+
+
+def graph_delta(groups, wanted):
+    """The entries of `wanted`, by group and object id, that differ from the
+    `groups` of a permission graph"""
+    delta = {}
+    for group_id, objects in wanted.items():
+        current = groups.get(group_id) or {}
+        for object_id, value in objects.items():
+            if not cell_matches(current.get(object_id), value):
+                delta.setdefault(group_id, {})[object_id] = value
+    return delta
+
+
+def update_graph(mb, endpoint, wanted, attempts=3):
+    """Bring the permission graph at `endpoint` in line with `wanted`.
+
+    Metabase only changes the entries of the graph that are sent, so this sends
+    the changed ones together with the revision of the graph they were computed
+    from, and nothing if the graph already matches. If the graph was changed in
+    the meantime, metabase refuses the update and the changes are computed again.
+    Returns the number of changed entries.
+    """
+    for attempt in range(attempts):
+        graph = mb.get(endpoint, cache=False).json()
+        delta = graph_delta(graph["groups"], wanted)
+        if not delta:
+            log.info("{} is up to date".format(endpoint))
+            return 0
+        changed = sum(len(objects) for objects in delta.values())
+        result = mb.put(endpoint, json={"revision": graph["revision"], "groups": delta})
+        if result.ok:
+            log.info("Changed {} entries of {}".format(changed, endpoint))
+            return changed
+        if result.status_code != 409:
+            raise RuntimeError(
+                "Updating {} failed with {}".format(endpoint, result.status_code)
+            )
+        log.warning("{} was changed concurrently, trying again".format(endpoint))
+    raise PermissionGraphConflict(
+        "{} changed during {} attempts to update it".format(endpoint, attempts)
+    )
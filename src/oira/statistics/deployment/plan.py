@@ -0,0 +1,277 @@
+from .cassette import raw_response
+from .instrumentation import endpoint_template
+from .users import read_users_csv
+
+import itertools
+import json
+import logging
+import os
+import re
+import requests
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Ids of objects that would be created. Metabase ids are positive, these are
+# far enough from the small negative numbers in visualization settings.
+PLACEHOLDER_START = -1000000
+
+graph_endpoints = ("/api/permissions/graph", "/api/collection/graph")
+
+# Placeholder for a password in a plan file
+secret_placeholder = re.compile(r"^\$\{secret:(.+)\}$")
+
+
+class NotPlannable(Exception):
+    """Raised when a step needs data that only exists once the plan is applied,
+    e.g. the tables of a database that has not been added yet"""
+
+
+def planned_response(status, body=None):
+    content = b"" if body is None else json.dumps(body).encode("utf-8")
+    response = requests.Response()
+    response.status_code = status
+    response.headers["Content-Type"] = "application/json"
+    response.raw = raw_response(content, {}, status)
+    return response
+
+
+def flatten(value, path=()):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, path + (str(key),))
+    else:
+        yield path, value
+
+
+def plan_secrets(args):
+    """The passwords that requests may contain, by the name they have in a plan
+    file. They are taken from the options both when planning and applying."""
+    secrets = {
+        "database-password": args.database_password,
+        "ldap-password": args.ldap_password,
+    }
+    users = list(args.statistics_user or [])
+    if args.statistics_users_csv:
+        users.extend(read_users_csv(args.statistics_users_csv))
+    for email, password, first_name, last_name in users:
+        secrets["statistics-user:{}".format(email.lower())] = password
+    return {name: secret for name, secret in secrets.items() if secret}
+
+
+def redact(value, secrets, key=""):
+    """Replace the passwords in a request body by placeholders"""
+    if isinstance(value, dict):
+        return {
+            item_key: redact(item, secrets, item_key)
+            for item_key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item, secrets, key) for item in value]
+    if isinstance(value, str) and value:
+        for name, secret in secrets.items():
+            if value == secret:
+                return "${{secret:{}}}".format(name)
+        if "password" in str(key):
+            # a password that isn't one of the options, it can't be applied
+            return "${secret:unknown}"
+    return value
+
+
+def graph_changes(before, after):
+    """The changed entries of a permission graph as (path, old, new)"""
+    old = dict(flatten(before.get("groups", {})))
+    return [
+        (path, old.get(path), value)
+        for path, value in flatten(after.get("groups", {}))
+        if old.get(path) != value
+    ]
+
+
+class Plan(object):
+    """The changes that setting up a metabase instance would make.
+
+    While planning, the metabase client passes every write to `intercept`, which
+    records it and answers it without contacting metabase. Objects that would
+    be created get placeholder ids, which `apply` replaces by the real ids.
+
+    Passwords are replaced by placeholders in the recorded changes, so that
+    plan files don't contain them. `apply` takes them from the options again.
+    """
+
+    def __init__(self, changes=None, incomplete=None, secrets=None):
+        self.changes = changes or []
+        self.incomplete = incomplete or []
+        self.secrets = secrets or {}
+        self.graphs = {}
+        self._planned = {}
+        self._ids = itertools.count(PLACEHOLDER_START, -1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as plan_file:
+            data = json.load(plan_file)
+        return cls(data["changes"], data["incomplete"])
+
+    def save(self, path):
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # only the owner may read the plan, also if the file existed before
+        os.fchmod(descriptor, 0o600)
+        with open(descriptor, "w") as plan_file:
+            json.dump(
+                {"changes": self.changes, "incomplete": self.incomplete},
+                plan_file,
+                indent=2,
+            )
+
+    def intercept(self, method, endpoint, body=None):
+        """A response to a planned request, or None to send a GET to metabase"""
+        if method == "GET":
+            return self._planned_read(endpoint)
+        change = {
+            "method": method,
+            "endpoint": endpoint,
+            "json": redact(body, self.secrets),
+        }
+        with self._lock:
+            if endpoint in graph_endpoints:
+                change["changes"] = graph_changes(self.graphs.get(endpoint, {}), body)
+            if method == "POST":
+                change["placeholder"] = next(self._ids)
+                self._planned["{}/{}".format(endpoint, change["placeholder"])] = dict(
+                    body or {}, id=change["placeholder"]
+                )
+            self.changes.append(change)
+        if method == "DELETE":
+            return planned_response(204)
+        if "placeholder" in change:
+            return planned_response(200, dict(body or {}, id=change["placeholder"]))
+        obj_id = re.search(r"/(-?\d+)$", endpoint)
+        if obj_id:
+            return planned_response(200, dict(body or {}, id=int(obj_id.group(1))))
+        return planned_response(200, dict(body or {}))
+
+    def _planned_read(self, endpoint):
+        if not re.search(r"/-\d+(?=/|\?|$)", endpoint):
+            return None
+        path = endpoint.partition("?")[0]
+        # a new dashboard has no cards yet, everything else that would be
+        # created (e.g. the tables of a new database) can't be known in advance
+        if path.startswith("/api/dashboard/") and path in self._planned:
+            return planned_response(200, dict(self._planned[path], ordered_cards=[]))
+        raise NotPlannable("GET {} needs an object that doesn't exist yet".format(path))
+
+    def observe(self, endpoint, result):
+        """Remember the live permission graphs to show what changes in them"""
+        if endpoint in graph_endpoints and result.ok:
+            with self._lock:
+                self.graphs[endpoint] = result.json()
+
+    @property
+    def writes(self):
+        return len(self.changes)
+
+    def describe(self, change):
+        method, endpoint, body = change["method"], change["endpoint"], change["json"]
+        name = (body or {}).get("name")
+        if "changes" in change:
+            return "update {} ({} entries)".format(endpoint, len(change["changes"]))
+        if method == "POST" and name:
+            return "create {} '{}'".format(endpoint_template(endpoint), name)
+        if method == "PUT" and name:
+            return "update {} '{}'".format(endpoint, name)
+        if method == "DELETE":
+            return "delete {}".format(endpoint)
+        return "{} {}".format(method, endpoint)
+
+    def report(self, stats=None):
+        lines = []
+        for change in self.changes:
+            lines.append("  " + self.describe(change))
+            for path, old, new in change.get("changes", []):
+                lines.append("      {}: {} -> {}".format("/".join(path), old, new))
+        counts = {}
+        for change in self.changes:
+            counts[change["method"]] = counts.get(change["method"], 0) + 1
+        summary = "{} changes ({})".format(
+            self.writes,
+            ", ".join(
+                "{} {}".format(count, method)
+                for method, count in sorted(counts.items())
+            )
+            or "nothing to do",
+        )
+        if stats is not None and len(stats):
+            latency = sum(entry["latency"] for entry in stats.requests) / len(stats)
+            summary += (
+                "; planning took {} requests, applying takes {} requests, about "
+                "{:.0f}s at the average latency of {:.0f}ms".format(
+                    len(stats),
+                    self.writes,
+                    self.writes * latency,
+                    latency * 1000,
+                )
+            )
+        lines.insert(0, summary)
+        for step in self.incomplete:
+            lines.append(
+                "  {} can only be planned after applying this plan".format(step)
+            )
+        return "\n".join(lines)
+
+    def apply(self, mb, secrets=None):
+        """Make the planned changes with the metabase client `mb`, with the
+        passwords in `secrets`, see plan_secrets"""
+        if self.incomplete:
+            raise NotPlannable(
+                "The plan is incomplete ({}), set up the instance without --apply"
+                "".format(", ".join(self.incomplete))
+            )
+        ids = {}
+
+        def replace(value):
+            if isinstance(value, dict):
+                return {replace(key): replace(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [replace(item) for item in value]
+            if isinstance(value, int) and value in ids:
+                return ids[value]
+            if isinstance(value, str) and secret_placeholder.match(value):
+                name = secret_placeholder.match(value).group(1)
+                if name not in (secrets or {}):
+                    raise ValueError(
+                        "The plan needs the password {}, pass the same options to "
+                        "--apply as to --plan".format(name)
+                    )
+                return secrets[name]
+            if isinstance(value, str) and value.lstrip("-").isdigit():
+                return str(ids.get(int(value), value))
+            return value
+
+        for number, change in enumerate(self.changes, 1):
+            endpoint = re.sub(
+                r"(?<=[/=])-\d+",
+                lambda match: str(ids.get(int(match.group()), match.group())),
+                change["endpoint"],
+            )
+            log.info(
+                "{}/{}: {} {}".format(
+                    number, len(self.changes), change["method"], endpoint
+                )
+            )
+            kwargs = {}
+            if change["json"] is not None:
+                kwargs["json"] = replace(change["json"])
+            result = mb.request(change["method"], endpoint, **kwargs)
+            if not result.ok:
+                raise RuntimeError(
+                    "{} {} failed with {}, stopping".format(
+                        change["method"], endpoint, result.status_code
+                    )
+                )
+            if "placeholder" in change and result.content:
+                obj_id = result.json().get("id")
+                if obj_id is not None:
+                    ids[change["placeholder"]] = obj_id
@@ -0,0 +1,177 @@
+from contextlib import contextmanager
+from functools import wraps
+
+import inspect
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+
+log = logging.getLogger(__name__)
+
+# Arguments that tell the calls of a method apart in the profile
+context_arguments = ("country", "sector_name", "obj_type")
+
+
+class Profiler(object):
+    """Times the methods of a set up and counts the requests they send.
+
+    Calls of the profiled methods become spans, nested per thread. Requests are
+    counted for all spans open in the thread that sends them, see `observe`;
+    requests that a method sends from a thread pool of its own are not counted
+    for it. With `memory`, tracemalloc records the peak memory of every step
+    that isn't nested in another one. The peak is global, so with concurrent
+    steps it includes the allocations of the others.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.roots = []
+        self.spans = []
+        self.unattributed = 0
+        self.started = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, label):
+        stack = self._stack
+        span = {
+            "label": label,
+            "thread": threading.current_thread().name,
+            "start": time.perf_counter() - self.started,
+            "end": None,
+            "requests": 0,
+            "peak": None,
+            "children": [],
+        }
+        if self.memory and not stack and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            span["end"] = time.perf_counter() - self.started
+            if self.memory and not stack:
+                span["peak"] = tracemalloc.get_traced_memory()[1]
+            with self._lock:
+                self.spans.append(span)
+                (stack[-1]["children"] if stack else self.roots).append(span)
+
+    def wrap(self, name, func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def profiled(*args, **kwargs):
+            try:
+                arguments = signature.bind_partial(*args, **kwargs).arguments
+            except TypeError:
+                arguments = {}
+            context = [
+                str(arguments[key])
+                for key in context_arguments
+                if arguments.get(key) is not None
+            ]
+            label = "{} ({})".format(name, ", ".join(context)) if context else name
+            with self.span(label):
+                return func(*args, **kwargs)
+
+        return profiled
+
+    def profile_methods(self, obj, names):
+        """Replace the methods `names` of `obj` by profiled ones"""
+        for name in names:
+            setattr(obj, name, self.wrap(name, getattr(obj, name)))
+
+    def observe(self, entry):
+        """Count a request for the spans open in the current thread, see
+        RequestStats.observers"""
+        stack = self._stack
+        if not stack:
+            with self._lock:
+                self.unattributed += 1
+        for span in stack:
+            span["requests"] += 1
+
+    def tree(self):
+        """The spans as an indented tree. Calls of a method with the same
+        context are summed up, the nested ones of all of them together."""
+        lines = [
+            "{:<60} {:>6} {:>9} {:>9}{}".format(
+                "step",
+                "calls",
+                "seconds",
+                "requests",
+                "  peak kB" if self.memory else "",
+            )
+        ]
+
+        def add(spans, depth):
+            groups = {}
+            for span in sorted(spans, key=lambda span: span["start"]):
+                groups.setdefault(span["label"], []).append(span)
+            for label, group in groups.items():
+                peaks = [span["peak"] for span in group if span["peak"] is not None]
+                lines.append(
+                    "{:<60} {:>6} {:>9.2f} {:>9}{}".format(
+                        ("  " * depth + label)[:60],
+                        len(group),
+                        sum(span["end"] - span["start"] for span in group),
+                        sum(span["requests"] for span in group),
+                        " {:>9.0f}".format(max(peaks) / 1024) if peaks else "",
+                    )
+                )
+                add([child for span in group for child in span["children"]], depth + 1)
+
+        add(self.roots, 0)
+        if self.unattributed:
+            lines.append(
+                "{} requests outside of the profiled steps".format(self.unattributed)
+            )
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """Write the spans in the Chrome trace event format, for chrome://tracing
+        or https://ui.perfetto.dev"""
+        threads = {}
+        events = []
+        for span in sorted(self.spans, key=lambda span: span["start"]):
+            tid = threads.setdefault(span["thread"], len(threads) + 1)
+            args = {"requests": span["requests"]}
+            if span["peak"] is not None:
+                args["peak_kb"] = round(span["peak"] / 1024)
+            events.append(
+                {
+                    "name": span["label"],
+                    "cat": "step",
+                    "ph": "X",
+                    "ts": round(span["start"] * 1e6),
+                    "dur": round((span["end"] - span["start"]) * 1e6),
+                    "pid": 1,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+        for name, tid in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
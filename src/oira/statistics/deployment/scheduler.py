@@ -0,0 +1,259 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class Result(object):
+    """Placeholder for the return value of another task.
+
+    Tasks that get a Result as an argument, also nested in dicts, lists or tuples,
+    depend on that task and receive its return value in its place.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Result({!r})".format(self.name)
+
+
+def find_results(value):
+    if isinstance(value, Result):
+        yield value.name
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from find_results(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from find_results(item)
+
+
+def resolve(value, results):
+    if isinstance(value, Result):
+        return results[value.name]
+    elif isinstance(value, dict):
+        return {key: resolve(item, results) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return type(value)(resolve(item, results) for item in value)
+    return value
+
+
+class Task(object):
+    def __init__(self, name, func, args, kwargs, depends, waiting=False):
+        self.name = name
+        self.func = func
+        self.waiting = waiting
+        self.args = args
+        self.kwargs = kwargs
+        self.depends = list(depends)
+        for dependency in find_results((args, kwargs)):
+            if dependency not in self.depends:
+                self.depends.append(dependency)
+        self.state = "pending"
+        self.inputs = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+class TaskFailed(Exception):
+    """Raised by Scheduler.run if any task failed"""
+
+
+class Scheduler(object):
+    """Runs tasks as soon as the tasks they depend on have finished.
+
+    Up to `jobs` tasks run concurrently on a thread pool. With a single job the
+    tasks run one after the other in the order they were added. If a task fails,
+    the tasks that depend on it, directly or indirectly, are skipped while all
+    others still run; `run` raises TaskFailed at the end. Failures with one of
+    the `expected` exception types are logged without a traceback.
+
+    Tasks added with `waiting=True` spend most of their time waiting for
+    metabase, e.g. for a database sync, and don't count against `jobs`.
+
+    With a `journal`, see journal.Journal, tasks that already completed with the
+    same arguments in an earlier run are not run again but return their
+    recorded result.
+    """
+
+    def __init__(self, jobs=1, expected=(), journal=None):
+        if jobs < 1:
+            raise ValueError("At least one job is needed, got {}".format(jobs))
+        self.jobs = jobs
+        self.expected = expected
+        self.journal = journal
+        self.tasks = {}
+        self.results = {}
+        self.started = None
+        self.finished = None
+
+    def add(self, name, func, *args, depends=(), waiting=False, **kwargs):
+        if name in self.tasks:
+            raise ValueError("Duplicate task {}".format(name))
+        task = Task(name, func, args, kwargs, depends, waiting=waiting)
+        unknown = [dependency for dependency in task.depends if dependency not in self]
+        if unknown:
+            raise ValueError(
+                "Task {} depends on unknown tasks {}".format(name, ", ".join(unknown))
+            )
+        self.tasks[name] = task
+        return Result(name)
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def select(self, names):
+        """Only keep the tasks `names` and the tasks they depend on, directly or
+        indirectly. Returns the names of the tasks only kept as dependencies."""
+        needed = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.tasks[name].depends)
+        self.tasks = {name: task for name, task in self.tasks.items() if name in needed}
+        return needed - set(names)
+
+    def _execute(self, task):
+        task.start = time.perf_counter() - self.started
+        try:
+            return task.func(
+                *resolve(task.args, self.results), **resolve(task.kwargs, self.results)
+            )
+        finally:
+            task.end = time.perf_counter() - self.started
+
+    def run(self):
+        self.started = time.perf_counter()
+        running = {}
+        waiting = len([task for task in self.tasks.values() if task.waiting])
+        with ThreadPoolExecutor(max_workers=self.jobs + waiting) as executor:
+            while True:
+                for task in self.tasks.values():
+                    if task.state != "pending":
+                        continue
+                    states = [self.tasks[name].state for name in task.depends]
+                    if any(state in ("failed", "skipped") for state in states):
+                        log.error(
+                            "Skipping {} because a task it depends on failed".format(
+                                task.name
+                            )
+                        )
+                        task.state = "skipped"
+                    elif all(state == "done" for state in states):
+                        if self.journal is not None:
+                            task.inputs = self.journal.inputs(
+                                resolve(task.args, self.results),
+                                resolve(task.kwargs, self.results),
+                            )
+                            completed, result = self.journal.lookup(
+                                task.name, task.inputs
+                            )
+                            if completed:
+                                self.results[task.name] = result
+                                task.state = "done"
+                                continue
+                        busy = [
+                            other for other in running.values() if not other.waiting
+                        ]
+                        if not task.waiting and len(busy) >= self.jobs:
+                            continue
+                        task.state = "running"
+                        running[executor.submit(self._execute, task)] = task
+                if not running:
+                    pending = [
+                        task.name
+                        for task in self.tasks.values()
+                        if task.state == "pending"
+                    ]
+                    if pending:
+                        raise RuntimeError(
+                            "Tasks {} can't be started".format(", ".join(pending))
+                        )
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        self.results[task.name] = future.result()
+                    except self.expected as e:
+                        log.warning("Task {} failed: {}".format(task.name, e))
+                        task.state = "failed"
+                        task.error = e
+                    except Exception as e:
+                        log.exception("Task {} failed".format(task.name))
+                        task.state = "failed"
+                        task.error = e
+                    else:
+                        task.state = "done"
+                        if self.journal is not None:
+                            self.journal.record(
+                                task.name, task.inputs, self.results[task.name]
+                            )
+        self.finished = time.perf_counter()
+
+        failed = [task.name for task in self.tasks.values() if task.state == "failed"]
+        if failed:
+            raise TaskFailed(
+                "Failed tasks: {}; {} tasks skipped".format(
+                    ", ".join(failed),
+                    len(
+                        [
+                            task
+                            for task in self.tasks.values()
+                            if task.state == "skipped"
+                        ]
+                    ),
+                )
+            )
+        return self.results
+
+    def critical_path(self):
+        """The chain of dependent tasks with the longest total duration"""
+        longest = {}
+        for task in self.tasks.values():
+            # tasks can only depend on tasks added before them
+            previous = max(
+                (longest[name] for name in task.depends),
+                key=lambda path: path[0],
+                default=(0.0, []),
+            )
+            longest[task.name] = (previous[0] + task.duration, previous[1] + [task])
+        return max(longest.values(), key=lambda path: path[0], default=(0.0, []))[1]
+
+    def report(self):
+        wall_clock = (self.finished or time.perf_counter()) - self.started
+        busy = sum(task.duration for task in self.tasks.values())
+        path = self.critical_path()
+        lines = [
+            "{} tasks in {:.1f}s with {} jobs ({:.1f}s of work), critical path "
+            "{:.1f}s:".format(
+                len(self.tasks),
+                wall_clock,
+                self.jobs,
+                busy,
+                sum(task.duration for task in path),
+            )
+        ]
+        for task in path:
+            # tasks that were skipped or resumed from the journal didn't run
+            if task.start is None:
+                continue
+            lines.append(
+                "  {:>7.1f}s {:>7.1f}s  {}".format(task.start, task.duration, task.name)
+            )
+        return "\n".join(lines)
@@ -1,19 +1,45 @@
 # -*- coding: utf-8 -*-
 from . import model
 from .initializer import MetabaseInitializer
+from .instrumentation import RequestStats
+from .plan import Plan
+from .plan import plan_secrets
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
 
 import argparse
+import configparser
 import logging
 import requests
 import sys
+import threading
+import time
 
 
 log = logging.getLogger(__name__)
 
+selector_kinds = ("country", "sector", "dashboard", "step")
 
-def get_metabase_args():
+
+def selector(value):
+    """Parse an --only selector like country=fr,de"""
+    kind, sep, values = value.partition("=")
+    values = [item.strip().lower() for item in values.split(",") if item.strip()]
+    if not sep or kind not in selector_kinds or not values:
+        raise argparse.ArgumentTypeError(
+            "expected KIND=VALUES with KIND one of {}".format(", ".join(selector_kinds))
+        )
+    return kind, values
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("expected at least 1, got {}".format(value))
+    return number
+
+
+def metabase_parser():
     parser = argparse.ArgumentParser(
         description=(
             "Initialize a metabase instance that has been freshly restored from a SQL "
@@ -46,6 +72,131 @@ def get_metabase_args():
         required=True,
         help=("Password for connecting to the metabase instance"),
     )
+    parser.add_argument(
+        "--metabase-pool-size",
+        type=int,
+        required=False,
+        default=10,
+        help=("Number of keep-alive connections to the metabase instance to reuse"),
+    )
+    parser.add_argument(
+        "--metabase-timeout",
+        type=float,
+        required=False,
+        default=120,
+        help=("Seconds to wait for a response from the metabase instance"),
+    )
+    parser.add_argument(
+        "--metabase-retries",
+        type=int,
+        required=False,
+        default=3,
+        help=(
+            "How often a request that failed with a server error, timeout or "
+            "connection error is retried"
+        ),
+    )
+    parser.add_argument(
+        "--metabase-retry-budget",
+        type=int,
+        required=False,
+        default=100,
+        help=("Maximum number of retries during the whole run"),
+    )
+    parser.add_argument(
+        "--metabase-max-concurrency",
+        type=int,
+        help=(
+            "If passed, the number of concurrent requests to metabase is adapted to "
+            "its latency and error rate, up to this number"
+        ),
+    )
+    parser.add_argument(
+        "--metabase-min-concurrency",
+        type=int,
+        default=1,
+        help=("Lower bound for the adaptive number of concurrent requests"),
+    )
+    parser.add_argument(
+        "--metabase-cache",
+        action="store_true",
+        help=(
+            "If passed, responses to GET requests are cached during the run and "
+            "identical concurrent requests are only sent once."
+        ),
+    )
+    parser.add_argument(
+        "--metabase-compress-requests",
+        action="store_true",
+        help=(
+            "If passed, large request bodies are sent gzip compressed. Falls back to "
+            "uncompressed bodies if the metabase instance rejects them."
+        ),
+    )
+    parser.add_argument(
+        "--record-cassette",
+        type=str,
+        metavar="PATH",
+        help=("Record all requests to metabase and their responses to this file"),
+    )
+    parser.add_argument(
+        "--replay-cassette",
+        type=str,
+        metavar="PATH",
+        help=(
+            "Answer all requests from a file written with --record-cassette instead "
+            "of contacting metabase or the statistics databases"
+        ),
+    )
+    parser.add_argument(
+        "--replay-latency",
+        type=str,
+        default="0",
+        help=(
+            "Seconds to wait before each replayed response, or 'recorded' to wait as "
+            "long as the recorded request took. Default: 0"
+        ),
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=str,
+        help=("File to write statistics about all requests to metabase to as JSON"),
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="PATH",
+        help=(
+            "Log the time and the number of requests of every set up step and "
+            "write them to PATH in the Chrome trace event format"
+        ),
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help=("With --profile, also record the peak memory of every step"),
+    )
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument(
+        "--plan",
+        type=str,
+        metavar="PATH",
+        help=(
+            "Only read the state of the metabase instance, log the changes that "
+            "setting it up would make and an estimate of the requests needed, and "
+            "write them to this file. Passwords are left out of the file, pass the "
+            "same password options to --apply."
+        ),
+    )
+    plan_group.add_argument(
+        "--apply",
+        type=str,
+        metavar="PATH",
+        help=(
+            "Make exactly the changes of a file written with --plan, with the "
+            "passwords from the options. Can't be combined with --only or --resume."
+        ),
+    )
     parser.add_argument(
         "--database-name", type=str, help=("Name of the internal metabase database")
     )
@@ -82,6 +233,56 @@ def get_metabase_args():
         required=True,
         help=("Password for connecting to the postgresql server"),
     )
+    parser.add_argument(
+        "--database-sync-timeout",
+        type=float,
+        default=600,
+        help=(
+            "Seconds to wait for metabase to sync a newly added statistics database. "
+            "Default: 600"
+        ),
+    )
+    parser.add_argument(
+        "--database-sync-concurrency",
+        type=int,
+        default=1,
+        help=(
+            "Number of statistics databases to sync at the same time. The syncs "
+            "and their metadata requests run in addition to --jobs and enlarge "
+            "the connection pool accordingly. Default: 1"
+        ),
+    )
+    parser.add_argument(
+        "--metadata-state",
+        type=str,
+        metavar="PATH",
+        help=(
+            "File to remember the fingerprints of the statistics tables in. If "
+            "given, the values of a table are only scanned again if its "
+            "fingerprint changed since the last scan, or the last scan is older "
+            "than --metadata-rescan-interval."
+        ),
+    )
+    parser.add_argument(
+        "--metadata-rescan-interval",
+        type=float,
+        default=86400,
+        help=(
+            "Seconds after which the values of the statistics tables are scanned "
+            "again with --metadata-state, also if their fingerprints didn't "
+            "change. Default: 86400"
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        metavar="PATH",
+        help=(
+            "Journal of the completed set up steps. Steps that completed in an "
+            "earlier run that failed are skipped, unless their inputs, the options "
+            "or the code changed. The journal is removed after a successful run."
+        ),
+    )
     parser.add_argument(
         "--database-name-statistics",
         type=str,
@@ -108,6 +309,23 @@ def get_metabase_args():
             "for a non-superuser account to create for viewing the statistics"
         ),
     )
+    parser.add_argument(
+        "--statistics-users-csv",
+        type=str,
+        metavar="PATH",
+        help=(
+            "CSV file with the columns email, password, first_name and last_name of "
+            "more statistics users, see --statistics-user"
+        ),
+    )
+    parser.add_argument(
+        "--reset-passwords",
+        action="store_true",
+        help=(
+            "Also set the passwords of statistics users that already exist. By "
+            "default only new users get a password"
+        ),
+    )
     parser.add_argument(
         "--global-statistics",
         action="store_true",
@@ -121,6 +339,25 @@ def get_metabase_args():
             "dashboards and cards will be set up."
         ),
     )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=1,
+        help=("Number of set up steps to run concurrently. Default: 1"),
+    )
+    parser.add_argument(
+        "--only",
+        type=selector,
+        action="append",
+        metavar="KIND=VALUES",
+        help=(
+            "Only set up the parts that match, e.g. country=fr,de, sector=HORECA, "
+            "dashboard=questionnaire or step=permissions. The steps are settings, "
+            "group, database, sync, collection, dashboard, sector, permissions, "
+            "ldap and users. Can be given more than once; the objects the selected "
+            "parts need are still looked up or created."
+        ),
+    )
     parser.add_argument(
         "--ldap-host",
         type=str,
@@ -157,7 +394,22 @@ def get_metabase_args():
         default="givenName",
         help=("LDAP attribute to use as first name"),
     )
-    return parser.parse_args()
+    return parser
+
+
+def parse_metabase_args(parser, argv=None):
+    args = parser.parse_args(argv)
+    if args.apply:
+        for option in ("only", "resume"):
+            if getattr(args, option):
+                parser.error(
+                    "argument --{}: not allowed with argument --apply".format(option)
+                )
+    return args
+
+
+def get_metabase_args(argv=None):
+    return parse_metabase_args(metabase_parser(), argv)
 
 
 def bootstrap_metabase_instance(args):
@@ -221,12 +473,171 @@ def init_statistics_databases(args):
             log.warning(f"Could not set up {database_name}: {e}")
 
 
+def set_up_metabase_instance(args, stats=None):
+    if not (args.replay_cassette or args.plan or args.apply):
+        init_statistics_databases(args)
+        bootstrap_metabase_instance(args)
+    initializer = MetabaseInitializer(args, stats=stats)
+    try:
+        if args.apply:
+            Plan.load(args.apply).apply(initializer.mb, secrets=plan_secrets(args))
+        else:
+            initializer()
+        if args.plan:
+            log.info(
+                "Plan:\n{}".format(initializer.mb.plan.report(initializer.mb.stats))
+            )
+            initializer.mb.plan.save(args.plan)
+    finally:
+        if args.stats_json:
+            initializer.mb.stats.write_json(args.stats_json)
+        if args.record_cassette:
+            initializer.cassette.save(args.record_cassette)
+        elif args.replay_cassette:
+            log.info(
+                "Replayed {} requests, {} not found in cassette".format(
+                    initializer.cassette.played, initializer.cassette.misses
+                )
+            )
+    return initializer
+
+
 def init_metabase_instance():
     logging.basicConfig(stream=sys.stderr, level=20)
     args = get_metabase_args()
 
     log.info("Initializing metabase instance")
-    init_statistics_databases(args)
-    bootstrap_metabase_instance(args)
-    initializer = MetabaseInitializer(args)
-    initializer()
+    stats = RequestStats()
+    try:
+        set_up_metabase_instance(args, stats=stats)
+    finally:
+        log.info("Requests to metabase:\n{}".format(stats.report()))
+
+
+def get_instances_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Wait for all metabase instances listed in a configuration file and "
+            "initialize them concurrently."
+        )
+    )
+    parser.add_argument(
+        "config",
+        type=str,
+        help=(
+            "INI file with a section per metabase instance. The keys are the options "
+            "of init-metabase-instance without the leading dashes; flags are set "
+            "with 'true', multiple statistics users go on separate lines. '-' reads "
+            "the configuration from stdin."
+        ),
+    )
+    parser.add_argument(
+        "--wait-timeout",
+        type=float,
+        default=60,
+        help=("Seconds to wait for the metabase instances to respond. Default: 60"),
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=str,
+        help=(
+            "File to write statistics about the requests to all metabase instances "
+            "to as JSON"
+        ),
+    )
+    return parser.parse_args()
+
+
+def read_instances(config_file):
+    """The arguments for init-metabase-instance for every section of `config_file`.
+
+    Only the options that are flags, e.g. global-statistics, take true or false;
+    all other values are passed on as they are.
+    """
+    metabase_args = metabase_parser()
+    flags = {
+        option
+        for action in metabase_args._actions
+        if action.nargs == 0
+        for option in action.option_strings
+    }
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_file(config_file)
+    instances = {}
+    for name in parser.sections():
+        argv = []
+        for key, value in parser.items(name):
+            option = "--{}".format(key)
+            if key == "statistics-user":
+                for user in value.splitlines():
+                    if user.strip():
+                        argv.extend(["--statistics-user"] + user.split())
+            elif option in flags:
+                if value == "true":
+                    argv.append(option)
+                elif value != "false":
+                    raise ValueError(
+                        "[{}] {} must be true or false, not {!r}".format(
+                            name, key, value
+                        )
+                    )
+            else:
+                argv.append("{}={}".format(option, value))
+        instances[name] = parse_metabase_args(metabase_args, argv)
+    return instances
+
+
+def wait_for_metabase(args, timeout=60):
+    """Poll the metabase instance until it responds at all"""
+    api_url = "http://{args.metabase_host}:{args.metabase_port}".format(args=args)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(api_url + "/api/user/current", timeout=5)
+            return
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+
+def init_metabase_instances():
+    logging.basicConfig(
+        stream=sys.stderr, level=20, format="%(threadName)s:%(name)s:%(message)s"
+    )
+    args = get_instances_args()
+    if args.config == "-":
+        instances = read_instances(sys.stdin)
+    else:
+        with open(args.config) as config_file:
+            instances = read_instances(config_file)
+
+    stats = RequestStats()
+    failed = []
+
+    def set_up(name):
+        instance_args = instances[name]
+        try:
+            if not instance_args.replay_cassette:
+                wait_for_metabase(instance_args, timeout=args.wait_timeout)
+                log.info("{} is up".format(name))
+            log.info("Initializing metabase instance {}".format(name))
+            set_up_metabase_instance(instance_args, stats=stats)
+        except Exception:
+            log.exception("Could not initialize {}".format(name))
+            failed.append(name)
+
+    threads = [
+        threading.Thread(target=set_up, args=(name,), name=name) for name in instances
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    log.info("Requests to metabase:\n{}".format(stats.report()))
+    if args.stats_json:
+        stats.write_json(args.stats_json)
+    if failed:
+        log.error("Failed to initialize {}".format(", ".join(failed)))
+        sys.exit(1)
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class DatabaseSyncTimeout(Exception):
+    """Raised if metabase doesn't finish syncing a database in time"""
+
+
+class DatabaseSyncFailed(Exception):
+    """Raised if metabase reports that syncing a database failed"""
+
+
+class DatabaseSyncs(object):
+    """Syncs of the statistics databases that run at the same time.
+
+    Up to `max_syncs` syncs are started at once. A sync is complete when a
+    "sync" entry for its database shows up in the task history of metabase that
+    is newer than the newest entry before the sync was started. The threads
+    waiting for a sync share the polling: one of them reads the task history,
+    with exponential backoff, and wakes up the others whose sync is complete.
+    Every sync adds many entries to the history, so it is read page by page
+    back to the oldest sync that is waited for.
+    """
+
+    def __init__(
+        self,
+        mb,
+        max_syncs=1,
+        timeout=600,
+        min_delay=0.5,
+        max_delay=10,
+        page_size=200,
+    ):
+        self.mb = mb
+        self.timeout = timeout
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.page_size = page_size
+        self.durations = {}
+        self._slots = threading.BoundedSemaphore(max_syncs)
+        self._condition = threading.Condition()
+        self._syncs = {}
+        self._status = {}
+        self._waiting = set()
+        self._since = {}
+        self._polling = False
+
+    def sync(self, db_id, db_name):
+        """Start syncing a database and wait until it is complete"""
+        with self._slots:
+            start = time.monotonic()
+            # nothing is synced while planning
+            if self.mb.plan is not None:
+                self.mb.post("/api/database/{}/sync".format(db_id))
+                return
+            previous = self._newest_task()
+            with self._condition:
+                self._since[db_id] = previous
+            try:
+                self.mb.post("/api/database/{}/sync".format(db_id))
+                self._wait(db_id, db_name, start, previous)
+            finally:
+                with self._condition:
+                    del self._since[db_id]
+        duration = time.monotonic() - start
+        log.info("Database {} synced after {:.1f}s".format(db_name, duration))
+        with self._condition:
+            self.durations[db_name] = duration
+
+    def _tasks(self, limit, offset=0):
+        return list(
+            self.mb.get_items(
+                "/api/task",
+                prefix="data.item",
+                keys=("id", "task", "db_id", "status"),
+                params={"limit": limit, "offset": offset},
+                cache=False,
+            )
+        )
+
+    def _newest_task(self):
+        """The id of the newest entry in the task history"""
+        return max([task["id"] for task in self._tasks(1)], default=0)
+
+    def _sync_tasks(self, since):
+        """The newest "sync" task of every database in the task history, of the
+        tasks newer than `since`"""
+        syncs = {}
+        offset = 0
+        while True:
+            page = self._tasks(self.page_size, offset)
+            for task in page:
+                if task["id"] <= since or task.get("task") != "sync":
+                    continue
+                newest = syncs.get(task.get("db_id"))
+                if newest is None or task["id"] > newest["id"]:
+                    syncs[task.get("db_id")] = task
+            if len(page) < self.page_size or any(task["id"] <= since for task in page):
+                return syncs
+            offset += self.page_size
+
+    def _poll(self):
+        with self._condition:
+            since = min(self._since.values(), default=0)
+        syncs = self._sync_tasks(since)
+        status = {
+            db["id"]: db.get("initial_sync_status")
+            for db in self.mb.get_items(
+                "/api/database",
+                prefix="data.item",
+                keys=("id", "initial_sync_status"),
+                cache=False,
+            )
+        }
+        with self._condition:
+            self._syncs = syncs
+            self._status = status
+            self._condition.notify_all()
+
+    def _finished(self, db_id, db_name, previous):
+        if self._status.get(db_id) == "aborted":
+            raise DatabaseSyncFailed("Metabase aborted syncing {}".format(db_name))
+        task = self._syncs.get(db_id)
+        if task is None or task["id"] <= previous:
+            return False
+        # metabase versions that record running tasks too have a status
+        if task.get("status") == "failed":
+            raise DatabaseSyncFailed("Syncing {} failed".format(db_name))
+        return task.get("status") in (None, "success")
+
+    def _check_timeout(self, db_name, start):
+        elapsed = time.monotonic() - start
+        if elapsed >= self.timeout:
+            raise DatabaseSyncTimeout(
+                "Database {} not synced after {:.0f}s".format(db_name, elapsed)
+            )
+        return self.timeout - elapsed
+
+    def _wait(self, db_id, db_name, start, previous):
+        with self._condition:
+            self._waiting.add(db_name)
+            try:
+                # only one thread polls at a time
+                while self._polling and not self._finished(db_id, db_name, previous):
+                    self._condition.wait(self._check_timeout(db_name, start))
+                if self._finished(db_id, db_name, previous):
+                    return
+                self._polling = True
+            finally:
+                self._waiting.discard(db_name)
+        delay = self.min_delay
+        try:
+            while True:
+                remaining = self._check_timeout(db_name, start)
+                self._poll()
+                with self._condition:
+                    if self._finished(db_id, db_name, previous):
+                        return
+                log.info(
+                    "Waiting for {} database syncs...".format(len(self._waiting) + 1)
+                )
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, self.max_delay)
+        finally:
+            with self._condition:
+                self._polling = False
+                self._condition.notify_all()
+
+    def report(self):
+        return ", ".join(
+            "{} {:.1f}s".format(db_name, duration)
+            for db_name, duration in sorted(self.durations.items())
+        )
+
+
+class MetadataState(object):
+    """Table fingerprints and the time their values were last scanned, by
+    database and table name.
+
+    Metabase doesn't update the fingerprints of fields when rows are added, so
+    values are also scanned again once the last scan is older than
+    `rescan_interval` seconds. Without a previous scan, e.g. when no state file
+    is used, the values are always scanned again.
+    """
+
+    def __init__(self, tables=None, rescan_interval=86400):
+        self.tables = tables or {}
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, rescan_interval=86400):
+        if not path or not os.path.exists(path):
+            return cls(rescan_interval=rescan_interval)
+        with open(path) as state_file:
+            return cls(json.load(state_file), rescan_interval=rescan_interval)
+
+    def save(self, path):
+        with open(path, "w") as state_file:
+            json.dump(self.tables, state_file, indent=2, sort_keys=True)
+
+    def rescan_needed(self, db_name, table_name, fingerprint):
+        with self._lock:
+            scan = self.tables.get(db_name, {}).get(table_name)
+        # the state of older versions only has the fingerprint
+        if not isinstance(scan, dict) or scan.get("fingerprint") != fingerprint:
+            return True
+        return time.time() - scan.get("scanned", 0) >= self.rescan_interval
+
+    def scanned(self, db_name, table_name, fingerprint):
+        with self._lock:
+            self.tables.setdefault(db_name, {})[table_name] = {
+                "fingerprint": fingerprint,
+                "scanned": time.time(),
+            }
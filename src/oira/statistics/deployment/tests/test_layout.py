@@ -0,0 +1,129 @@
+from oira.statistics.deployment.layout import DashboardLayout
+from oira.statistics.deployment.layout import dashcard_key
+from oira.statistics.deployment.layout import diff_dashcards
+
+import logging
+import unittest
+
+
+def existing(dashcard_id, card_id, col=0, row=0, series=(), **kwargs):
+    return dict(
+        {
+            "id": dashcard_id,
+            "card_id": card_id,
+            "col": col,
+            "row": row,
+            "size_x": 4,
+            "size_y": 4,
+            "series": [{"id": card} for card in series],
+            "visualization_settings": {},
+            "parameter_mappings": [],
+        },
+        **kwargs
+    )
+
+
+class TestDashboardLayout(unittest.TestCase):
+    def test_rows(self):
+        layout = DashboardLayout(total_cols=8)
+        layout.add_card(1, width=4, height=2)
+        layout.add_card(2, width=4, height=3)
+        layout.add_card(3, width=6)
+        self.assertEqual(
+            [
+                (dashcard["card_id"], dashcard["col"], dashcard["row"])
+                for dashcard in layout.dashcards
+            ],
+            [(1, 0, 0), (2, 4, 0), (3, 0, 4)],
+        )
+
+    def test_text(self):
+        layout = DashboardLayout()
+        layout.add_text("# Hello", size_x=16, size_y=2)
+        layout.col = 0
+        layout.add_card(1)
+        text, card = layout.dashcards
+        self.assertIsNone(text["card_id"])
+        self.assertEqual(text["visualization_settings"]["text"], "# Hello")
+        self.assertEqual((card["col"], card["row"]), (0, 2))
+
+
+class TestDiffDashcards(unittest.TestCase):
+    def wanted(self, *cards):
+        layout = DashboardLayout()
+        for card_id in cards:
+            layout.add_card(card_id)
+        return layout.dashcards
+
+    def test_unchanged(self):
+        dashcards = self.wanted(1, 2)
+        current = [existing(10, 1, col=0), existing(11, 2, col=4)]
+        self.assertEqual(diff_dashcards(current, dashcards), ([], [], []))
+
+    def test_missing_and_obsolete(self):
+        dashcards = self.wanted(1, 2)
+        current = [existing(10, 1, col=0), existing(11, 3, col=4)]
+        delete, add, update = diff_dashcards(current, dashcards)
+        self.assertEqual(delete, [11])
+        self.assertEqual([dashcard["card_id"] for dashcard in add], [2])
+        self.assertEqual(update, [])
+
+    def test_moved_card_is_updated_in_place(self):
+        dashcards = self.wanted(1, 2)
+        current = [existing(10, 1, col=0), existing(11, 2, col=8, row=4)]
+        delete, add, update = diff_dashcards(current, dashcards)
+        self.assertEqual((delete, add), ([], []))
+        self.assertEqual(len(update), 1)
+        self.assertEqual(update[0]["id"], 11)
+        self.assertEqual((update[0]["col"], update[0]["row"]), (4, 0))
+
+    def test_changed_size(self):
+        dashcards = self.wanted(1)
+        current = [existing(10, 1, size_y=2)]
+        delete, add, update = diff_dashcards(current, dashcards)
+        self.assertEqual([dashcard["id"] for dashcard in update], [10])
+
+    def test_parameter_mappings_are_kept(self):
+        dashcards = self.wanted(1)
+        mappings = [{"parameter_id": "p", "card_id": 1}]
+        current = [existing(10, 1, size_y=2, parameter_mappings=mappings)]
+        update = diff_dashcards(current, dashcards)[2]
+        self.assertEqual(update[0]["parameter_mappings"], mappings)
+
+
+class TestCombinedDashcards(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def wanted(self):
+        layout = DashboardLayout()
+        layout.place(1, 0, 0, series=[2, 3])
+        layout.place(1, 4, 0)
+        return layout.dashcards
+
+    def test_key(self):
+        self.assertEqual(
+            dashcard_key(existing(10, 1, series=[2, 3])),
+            dashcard_key(self.wanted()[0]),
+        )
+
+    def test_unchanged(self):
+        current = [existing(11, 1, col=4), existing(10, 1, series=[2, 3])]
+        self.assertEqual(diff_dashcards(current, self.wanted()), ([], [], []))
+
+    def test_duplicates_are_removed(self):
+        current = [
+            existing(10, 1, series=[2, 3]),
+            existing(11, 1, col=4),
+            existing(12, 1, series=[2, 3]),
+            existing(13, 1, series=[2, 3]),
+        ]
+        self.assertEqual(diff_dashcards(current, self.wanted()), ([12, 13], [], []))
+
+    def test_changed_series_is_updated_in_place(self):
+        current = [existing(10, 1, series=[2]), existing(11, 1, col=4)]
+        delete, add, update = diff_dashcards(current, self.wanted())
+        self.assertEqual((delete, add), ([], []))
+        self.assertEqual([dashcard["id"] for dashcard in update], [10])
+        self.assertEqual(update[0]["series"], [2, 3])
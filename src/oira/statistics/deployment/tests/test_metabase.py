@@ -0,0 +1,229 @@
+from oira.statistics.deployment.metabase import CircuitBreaker
+from oira.statistics.deployment.metabase import MetabaseUnavailable
+from oira.statistics.deployment.metabase import ResponseCache
+from oira.statistics.deployment.metabase import RetryPolicy
+
+import logging
+import threading
+import time
+import unittest
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_server_errors(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable("GET", status_code=503))
+        self.assertTrue(policy.is_retryable("PUT", status_code=500))
+        self.assertFalse(policy.is_retryable("GET", status_code=404))
+        self.assertFalse(policy.is_retryable("POST", status_code=503))
+
+    def test_network_errors(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable("DELETE", error="network"))
+        # the request may have been processed
+        self.assertFalse(policy.is_retryable("POST", error="network"))
+        # the request never reached metabase
+        self.assertTrue(policy.is_retryable("POST", error="connect"))
+
+    def test_safe_errors(self):
+        policy = RetryPolicy()
+        self.assertTrue(
+            policy.is_retryable(
+                "POST", status_code=500, message="ERROR: duplicate key value"
+            )
+        )
+
+    def test_backoff(self):
+        policy = RetryPolicy(max_attempts=10, base_delay=1, max_delay=5)
+        for attempt in range(6):
+            delay = policy.next_delay("GET", attempt, status_code=502)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(5, 2**attempt))
+
+    def test_max_attempts(self):
+        policy = RetryPolicy(max_attempts=3)
+        self.assertIsNotNone(policy.next_delay("GET", 1, status_code=502))
+        self.assertIsNone(policy.next_delay("GET", 2, status_code=502))
+
+    def test_not_retryable(self):
+        policy = RetryPolicy()
+        self.assertIsNone(policy.next_delay("GET", 0, status_code=400))
+        self.assertEqual(policy.retries, 0)
+
+    def test_budget(self):
+        policy = RetryPolicy(budget=2)
+        delays = [policy.next_delay("GET", 0, status_code=502) for i in range(3)]
+        self.assertIsNotNone(delays[1])
+        self.assertIsNone(delays[2])
+        self.assertTrue(policy.exhausted)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=60)
+        for i in range(2):
+            breaker.record_failure()
+        breaker.check()
+        breaker.record_failure()
+        with self.assertRaises(MetabaseUnavailable):
+            breaker.check()
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.check()
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.record_failure()
+        # the cooldown is over, a trial request is let through
+        breaker.check()
+        breaker.record_success()
+        self.assertIsNone(breaker.opened_at)
+
+    def test_failed_trial_stays_open(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.record_failure()
+        breaker.check()
+        breaker.cooldown = 60
+        breaker.record_failure()
+        with self.assertRaises(MetabaseUnavailable):
+            breaker.check()
+
+
+class Response(object):
+    def __init__(self, body, ok=True):
+        self.body = body
+        self.ok = ok
+
+
+class Loader(object):
+    def __init__(self, ok=True):
+        self.ok = ok
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return Response(self.calls, ok=self.ok)
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_hit(self):
+        cache = ResponseCache()
+        load = Loader()
+        self.assertEqual(cache.fetch("/api/card", None, load).body, 1)
+        self.assertEqual(cache.fetch("/api/card", None, load).body, 1)
+        self.assertEqual((cache.hits, cache.misses, load.calls), (1, 1, 1))
+
+    def test_key(self):
+        cache = ResponseCache()
+        self.assertEqual(
+            cache.key("/api/card/?b=2&a=1"), cache.key("/api/card?a=1&b=2")
+        )
+        self.assertNotEqual(
+            cache.key("/api/card", {"f": "all"}), cache.key("/api/card", {"f": "mine"})
+        )
+
+    def test_uncacheable(self):
+        cache = ResponseCache()
+        self.assertFalse(cache.cacheable("/api/user/current"))
+        self.assertFalse(cache.cacheable("/api/util/logs"))
+        self.assertTrue(cache.cacheable("/api/user"))
+
+    def test_errors_are_not_cached(self):
+        cache = ResponseCache()
+        load = Loader(ok=False)
+        cache.fetch("/api/card", None, load)
+        cache.fetch("/api/card", None, load)
+        self.assertEqual(load.calls, 2)
+
+    def test_single_flight(self):
+        cache = ResponseCache()
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def slow_load():
+            started.set()
+            release.wait(5)
+            return Response("listing")
+
+        def fetch(load):
+            results.append(cache.fetch("/api/card", None, load).body)
+
+        leader = threading.Thread(target=fetch, args=(slow_load,))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=fetch, args=(Loader(),))
+        follower.start()
+        deadline = time.monotonic() + 5
+        while not cache.coalesced and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(results, ["listing", "listing"])
+        self.assertEqual((cache.misses, cache.coalesced), (1, 1))
+
+    def test_failed_load_is_not_cached(self):
+        cache = ResponseCache()
+
+        def fail():
+            raise KeyError("broken")
+
+        with self.assertRaises(KeyError):
+            cache.fetch("/api/card", None, fail)
+        self.assertEqual(cache.fetch("/api/card", None, Loader()).body, 1)
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        for endpoint in [
+            "/api/card",
+            "/api/card/5",
+            "/api/card/5/query",
+            "/api/card/6",
+            "/api/dashboard",
+            "/api/database/1/metadata",
+        ]:
+            cache.fetch(endpoint, None, Loader())
+        cache.invalidate("/api/card/5")
+        cache.invalidate("/api/table/3")
+        self.assertEqual(
+            sorted(key[0] for key in cache._entries), ["/api/card/6", "/api/dashboard"]
+        )
+        self.assertEqual(cache.invalidations, 4)
+
+    def test_write_during_load(self):
+        cache = ResponseCache()
+
+        def load():
+            cache.invalidate("/api/card/5")
+            return Response("old")
+
+        cache.fetch("/api/card", None, load)
+        self.assertEqual(cache.fetch("/api/card", None, Loader()).body, 1)
+
+    def test_lru(self):
+        cache = ResponseCache(max_entries=2)
+        for endpoint in ["/api/card", "/api/dashboard", "/api/card", "/api/collection"]:
+            cache.fetch(endpoint, None, Loader())
+        self.assertEqual(
+            [key[0] for key in cache._entries], ["/api/card", "/api/collection"]
+        )
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=0)
+        load = Loader()
+        cache.fetch("/api/card", None, load)
+        cache.fetch("/api/card", None, load)
+        self.assertEqual(load.calls, 2)
@@ -0,0 +1,37 @@
+from oira.statistics.deployment.permissions import graph_delta
+
+import unittest
+
+
+class TestGraphDelta(unittest.TestCase):
+    def test_nothing_to_do(self):
+        groups = {"3": {"5": {"data": {"schemas": "all", "native": "write"}}}}
+        wanted = {"3": {"5": {"data": {"schemas": "all"}}}}
+        self.assertEqual(graph_delta(groups, wanted), {})
+
+    def test_changed_entry(self):
+        groups = {"3": {"5": {"data": {"schemas": "none"}}, "6": "read"}}
+        wanted = {"3": {"5": {"data": {"schemas": "all"}}, "6": "read"}}
+        self.assertEqual(
+            graph_delta(groups, wanted), {"3": {"5": {"data": {"schemas": "all"}}}}
+        )
+
+    def test_missing_entry_is_none(self):
+        wanted = {"3": {"5": {"data": {"schemas": "none"}}, "6": "none"}}
+        self.assertEqual(graph_delta({}, wanted), {})
+        self.assertEqual(graph_delta({"3": {}}, wanted), {})
+        self.assertEqual(graph_delta({"3": {"5": {"data": {}}}}, wanted), {})
+
+    def test_missing_entry_is_granted(self):
+        wanted = {"3": {"5": {"data": {"schemas": "all"}}, "6": "read"}}
+        self.assertEqual(graph_delta({}, wanted), wanted)
+
+    def test_granular_permissions_are_revoked(self):
+        groups = {"3": {"5": {"data": {"schemas": {"public": {"7": "all"}}}}}}
+        wanted = {"3": {"5": {"data": {"schemas": "none"}}}}
+        self.assertEqual(graph_delta(groups, wanted), wanted)
+
+    def test_granular_permissions_are_replaced(self):
+        groups = {"3": {"5": {"data": {"schemas": {"public": "all"}}}}}
+        wanted = {"3": {"5": {"data": {"schemas": "all"}}}}
+        self.assertEqual(graph_delta(groups, wanted), wanted)
@@ -0,0 +1,139 @@
+from oira.statistics.deployment.plan import NotPlannable
+from oira.statistics.deployment.plan import PLACEHOLDER_START
+from oira.statistics.deployment.plan import Plan
+from oira.statistics.deployment.plan import planned_response
+from oira.statistics.deployment.plan import redact
+
+import logging
+import unittest
+
+
+class Metabase(object):
+    """Records the requests of Plan.apply and answers POSTs with new ids"""
+
+    def __init__(self, status=200):
+        self.status = status
+        self.requests = []
+        self.next_id = 100
+
+    def request(self, method, endpoint, **kwargs):
+        self.requests.append((method, endpoint, kwargs.get("json")))
+        if method == "POST":
+            self.next_id += 1
+            return planned_response(self.status, {"id": self.next_id})
+        return planned_response(self.status, {})
+
+
+class TestRedact(unittest.TestCase):
+    secrets = {"database-password": "db-secret", "statistics-user:a@b.c": "pw"}
+
+    def test_secrets(self):
+        body = {
+            "details": {"password": "db-secret", "host": "localhost"},
+            "users": [{"email": "a@b.c", "password": "pw"}],
+        }
+        self.assertEqual(
+            redact(body, self.secrets),
+            {
+                "details": {
+                    "password": "${secret:database-password}",
+                    "host": "localhost",
+                },
+                "users": [
+                    {"email": "a@b.c", "password": "${secret:statistics-user:a@b.c}"}
+                ],
+            },
+        )
+
+    def test_unknown_password(self):
+        self.assertEqual(
+            redact({"password": "other", "name": "other"}, self.secrets),
+            {"password": "${secret:unknown}", "name": "other"},
+        )
+
+    def test_other_values(self):
+        body = {"id": 3, "password": "", "enabled": True, "settings": None}
+        self.assertEqual(redact(body, self.secrets), body)
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_intercept(self):
+        plan = Plan(secrets={"database-password": "db-secret"})
+        self.assertIsNone(plan.intercept("GET", "/api/database"))
+        result = plan.intercept(
+            "POST",
+            "/api/database",
+            {"name": "db", "details": {"password": "db-secret"}},
+        )
+        self.assertEqual(result.json()["id"], PLACEHOLDER_START)
+        self.assertEqual(
+            plan.changes[0]["json"]["details"]["password"],
+            "${secret:database-password}",
+        )
+        self.assertEqual(plan.intercept("PUT", "/api/card/5", {}).json(), {"id": 5})
+        self.assertEqual(plan.intercept("DELETE", "/api/card/5").status_code, 204)
+        self.assertEqual(plan.writes, 3)
+
+    def test_planned_reads(self):
+        plan = Plan()
+        dashboard = plan.intercept("POST", "/api/dashboard", {"name": "d"}).json()
+        result = plan.intercept("GET", "/api/dashboard/{}".format(dashboard["id"]))
+        self.assertEqual(result.json()["ordered_cards"], [])
+        database = plan.intercept("POST", "/api/database", {"name": "db"}).json()
+        with self.assertRaises(NotPlannable):
+            plan.intercept("GET", "/api/database/{}/metadata".format(database["id"]))
+
+    def test_apply_replaces_placeholders(self):
+        plan = Plan()
+        collection = plan.intercept("POST", "/api/collection", {"name": "c"}).json()
+        card = plan.intercept(
+            "POST", "/api/card", {"name": "k", "collection_id": collection["id"]}
+        ).json()
+        plan.intercept(
+            "PUT",
+            "/api/collection/graph",
+            {"groups": {"1": {str(collection["id"]): "read"}}},
+        )
+        plan.intercept(
+            "DELETE", "/api/dashboard/3/cards?dashcardId={}".format(card["id"])
+        )
+        plan.intercept("PUT", "/api/card/{}".format(card["id"]), {"name": "k2"})
+        mb = Metabase()
+        plan.apply(mb)
+        self.assertEqual(
+            mb.requests,
+            [
+                ("POST", "/api/collection", {"name": "c"}),
+                ("POST", "/api/card", {"name": "k", "collection_id": 101}),
+                ("PUT", "/api/collection/graph", {"groups": {"1": {"101": "read"}}}),
+                ("DELETE", "/api/dashboard/3/cards?dashcardId=102", None),
+                ("PUT", "/api/card/102", {"name": "k2"}),
+            ],
+        )
+
+    def test_apply_secrets(self):
+        plan = Plan(secrets={"database-password": "db-secret"})
+        plan.intercept("POST", "/api/database", {"details": {"password": "db-secret"}})
+        mb = Metabase()
+        plan.apply(mb, secrets={"database-password": "new-secret"})
+        self.assertEqual(mb.requests[0][2], {"details": {"password": "new-secret"}})
+        with self.assertRaises(ValueError):
+            plan.apply(Metabase())
+
+    def test_incomplete_plan(self):
+        plan = Plan(changes=[], incomplete=["sync:eu"])
+        with self.assertRaises(NotPlannable):
+            plan.apply(Metabase())
+
+    def test_apply_stops_on_errors(self):
+        plan = Plan()
+        plan.intercept("PUT", "/api/card/5", {"name": "k"})
+        plan.intercept("PUT", "/api/card/6", {"name": "l"})
+        mb = Metabase(status=500)
+        with self.assertRaises(RuntimeError):
+            plan.apply(mb)
+        self.assertEqual(len(mb.requests), 1)
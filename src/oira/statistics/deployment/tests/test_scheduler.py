@@ -0,0 +1,85 @@
+from oira.statistics.deployment.scheduler import Scheduler
+from oira.statistics.deployment.scheduler import TaskFailed
+
+import logging
+import threading
+import unittest
+
+
+def fail():
+    raise KeyError("broken")
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_results_are_passed_on(self):
+        scheduler = Scheduler()
+        one = scheduler.add("one", lambda: 1)
+        scheduler.add("two", lambda value, more: value + more, one, more=one)
+        self.assertEqual(scheduler.run(), {"one": 1, "two": 2})
+
+    def test_single_job_keeps_the_order(self):
+        order = []
+        scheduler = Scheduler()
+        for name in "abc":
+            scheduler.add(name, order.append, name)
+        scheduler.run()
+        self.assertEqual(order, ["a", "b", "c"])
+
+    def test_dependents_of_failed_tasks_are_skipped(self):
+        scheduler = Scheduler(jobs=2)
+        broken = scheduler.add("broken", fail)
+        scheduler.add("dependent", lambda value: value, broken)
+        scheduler.add("indirect", lambda: None, depends=["dependent"])
+        scheduler.add("independent", lambda: 1)
+        with self.assertRaises(TaskFailed):
+            scheduler.run()
+        self.assertEqual(
+            {name: task.state for name, task in scheduler.tasks.items()},
+            {
+                "broken": "failed",
+                "dependent": "skipped",
+                "indirect": "skipped",
+                "independent": "done",
+            },
+        )
+        self.assertIsInstance(scheduler.tasks["broken"].error, KeyError)
+
+    def test_waiting_tasks_dont_count_against_jobs(self):
+        # with one job, the waiting task only finishes if the other one can run
+        # next to it
+        synced = threading.Event()
+        scheduler = Scheduler(jobs=1)
+        scheduler.add("sync", synced.wait, 5, waiting=True)
+        scheduler.add("trigger", synced.set)
+        self.assertEqual(scheduler.run()["sync"], True)
+
+    def test_select(self):
+        scheduler = Scheduler()
+        database = scheduler.add("database", lambda: 1)
+        sync = scheduler.add("sync", lambda value: value, database)
+        scheduler.add("dashboard", lambda value: value, sync)
+        scheduler.add("other", lambda: None)
+        self.assertEqual(scheduler.select(["dashboard"]), {"database", "sync"})
+        self.assertEqual(list(scheduler.tasks), ["database", "sync", "dashboard"])
+
+    def test_unknown_dependency(self):
+        scheduler = Scheduler()
+        with self.assertRaises(ValueError):
+            scheduler.add("task", lambda: None, depends=["missing"])
+
+    def test_no_jobs(self):
+        with self.assertRaises(ValueError):
+            Scheduler(jobs=0)
+
+    def test_tasks_that_cant_start(self):
+        scheduler = Scheduler()
+        scheduler.add("task", lambda: None)
+        scheduler.add("sync", lambda: None, waiting=True)
+        scheduler.jobs = 0
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+        self.assertEqual(scheduler.tasks["sync"].state, "done")
@@ -0,0 +1,58 @@
+from contextlib import redirect_stderr
+from oira.statistics.deployment.scripts import get_metabase_args
+from oira.statistics.deployment.scripts import read_instances
+
+import io
+import unittest
+
+
+required = "metabase-user = a\nmetabase-password = b\ndatabase-user = u\n"
+
+
+class TestReadInstances(unittest.TestCase):
+    def read(self, config):
+        return read_instances(io.StringIO(config.replace("\n", "\n" + required, 1)))
+
+    def test_flags(self):
+        instances = self.read(
+            "[eu]\n"
+            "global-statistics = true\n"
+            "metabase-cache = false\n"
+            "database-password = p\n"
+        )
+        self.assertTrue(instances["eu"].global_statistics)
+        self.assertFalse(instances["eu"].metabase_cache)
+
+    def test_values_that_look_like_flags(self):
+        instances = self.read(
+            "[eu]\n" "database-password = true\n" "ldap-password = false\n"
+        )
+        self.assertEqual(instances["eu"].database_password, "true")
+        self.assertEqual(instances["eu"].ldap_password, "false")
+
+    def test_invalid_flag(self):
+        with self.assertRaises(ValueError):
+            self.read("[eu]\nglobal-statistics = yes\n")
+
+
+class TestGetMetabaseArgs(unittest.TestCase):
+    required = [
+        "--metabase-user=a",
+        "--metabase-password=b",
+        "--database-user=u",
+        "--database-password=p",
+    ]
+
+    def assertRejected(self, *argv):
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            get_metabase_args(self.required + list(argv))
+
+    def test_apply(self):
+        self.assertEqual(get_metabase_args(self.required + ["--apply=p"]).apply, "p")
+
+    def test_plan_and_apply(self):
+        self.assertRejected("--plan=p", "--apply=p")
+
+    def test_apply_ignores_selection(self):
+        self.assertRejected("--apply=p", "--only", "country=eu")
+        self.assertRejected("--apply=p", "--resume=r")
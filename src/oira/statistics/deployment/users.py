@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import csv
+import logging
+
+
+log = logging.getLogger(__name__)
+
+profile_fields = ("first_name", "last_name", "email")
+
+
+def read_users_csv(path):
+    """Read statistics users from a CSV file with the columns email, password,
+    first_name and last_name, in the format of --statistics-user"""
+    with open(path, newline="") as csv_file:
+        return [
+            (
+                row["email"].strip(),
+                row.get("password") or "",
+                row.get("first_name") or "",
+                row.get("last_name") or "",
+            )
+            for row in csv.DictReader(csv_file)
+            if (row.get("email") or "").strip()
+        ]
+
+
+class UserSync(object):
+    """Makes the statistics users in metabase match the configured ones.
+
+    The users are listed once, page by page; only users that are missing or
+    whose name or groups differ are created or updated, up to `workers` at a
+    time. Passwords of existing users are only set with `reset_passwords`.
+    Users that aren't configured are left alone.
+    """
+
+    def __init__(self, mb, group_ids, reset_passwords=False, workers=4, page_size=100):
+        self.mb = mb
+        self.group_ids = sorted(group_ids)
+        self.reset_passwords = reset_passwords
+        self.workers = workers
+        self.page_size = page_size
+
+    def existing_users(self):
+        users = {}
+        offset = 0
+        while True:
+            page = list(
+                self.mb.get_items(
+                    "/api/user",
+                    prefix="data.item",
+                    keys=("id", "group_ids") + profile_fields,
+                    params={"limit": self.page_size, "offset": offset},
+                )
+            )
+            for user in page:
+                users[user["email"].lower()] = user
+            if len(page) < self.page_size:
+                return users
+            offset += self.page_size
+
+    def diff(self, existing, configured):
+        """The requests that make `existing` users match `configured` ones, as
+        (method, endpoint, body) tuples"""
+        changes = []
+        for email, password, first_name, last_name in configured:
+            profile = {
+                "first_name": first_name,
+                "last_name": last_name,
+                "email": email,
+                "group_ids": self.group_ids,
+            }
+            user = existing.get(email.lower())
+            if user is None:
+                changes.append(("POST", "/api/user", dict(profile, password=password)))
+                continue
+            if any(user.get(field) != profile[field] for field in profile_fields) or (
+                sorted(user.get("group_ids") or []) != self.group_ids
+            ):
+                changes.append(("PUT", "/api/user/{}".format(user["id"]), profile))
+            if self.reset_passwords:
+                changes.append(
+                    (
+                        "PUT",
+                        "/api/user/{}/password".format(user["id"]),
+                        {"password": password},
+                    )
+                )
+        return changes
+
+    def _apply(self, change):
+        method, endpoint, body = change
+        log.info("{} {}".format(method, endpoint))
+        return self.mb.request(method, endpoint, json=body)
+
+    def sync(self, configured):
+        # the last entry for an email address wins
+        configured = list({user[0].lower(): user for user in configured}.values())
+        changes = self.diff(self.existing_users(), configured)
+        if changes:
+            with ThreadPoolExecutor(min(len(changes), self.workers)) as executor:
+                list(executor.map(self._apply, changes))
+        log.info(
+            "{} statistics users, {} changes".format(len(configured), len(changes))
+        )
+        return changes